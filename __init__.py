@@ -41,12 +41,21 @@
 from djangotasks.models import Task
 
 
-def register_task(method, documentation, *required_methods):
+def register_task(method, documentation, *required_methods, **options):
     ''' Register a method of a model class as a task that can be executed asynchronously
 
     The method must be an unbound method of a model class.
+
+    The options are:
+     - in_process: if True, the task is run in a thread of the scheduler process, instead of its own process. 
+       This is faster to start, for tasks that are quick to run. 
+       Such tasks cannot be killed when cancelled: they should check cancel_requested() regularly.
+     - priority: an integer, 0 by default. The scheduled tasks of the highest priority are started first.
+     - queue: the name of the queue of the task, 'default' by default. The number of running tasks 
+       of each queue can be limited with TASKS_QUEUE_MAX_RUNNING, and each node can serve only some queues
+       (see TASKS_QUEUES, and the --queues option of the taskd command).
     '''
-    Task.objects.register_task(method, documentation, *required_methods)
+    Task.objects.register_task(method, documentation, *required_methods, **options)
 
 
 def tasks_for_object(object):
@@ -66,21 +75,57 @@ def task_for_object(object_method):
     return Task.objects.task_for_object(object_method.im_class, object_method.im_self.pk, object_method.im_func.__name__)
 
 
-def task_for_function(function):
+def tasks_for_objects(queryset, method):
+    ''' Create (or find, if they have been created already) the tasks for this method, for all the objects of the queryset.
+
+    The parameter must be the method of the class, not of an object: for instance tasks_for_objects(MyModel.objects.all(), MyModel.my_method).
+    This is much faster than calling task_for_object for each object. 
+    The tasks are returned as an iterable, that loads them as it is iterated.'''
+    return Task.objects.tasks_for_objects(queryset, method.im_func.__name__)
+
+
+def run_tasks_for_queryset(queryset, method, tenant=None):
+    ''' Run the tasks for this method, for all the objects of the queryset, as run_task does for each of them.
+
+    The parameter must be the method of the class, as for tasks_for_objects. 
+    The objects for which the task (or a task it requires) is being cancelled are skipped.
+    tenant is the same as for run_task.
+    Returns the new tasks as an iterable, as tasks_for_objects does.'''
+    return Task.objects.run_tasks_for_queryset(queryset, method.im_func.__name__, tenant)
+
+# The same, named as tasks_for_objects
+run_tasks_for_objects = run_tasks_for_queryset
+
+
+def statuses_for_objects(objects):
+    ''' Return the status of the tasks of these model objects, e.g. for a web page that shows the progress of many objects.
+
+    The result is a dictionary of object to dictionary of method name to status (see Task.status). 
+    No task is created: the status of the tasks that have never been created is "defined".
+    With TASKS_STATUS_CACHE = True, the statuses are read from the Django cache, and only the other ones from the database.'''
+    return Task.objects.statuses_for_objects(objects)
+
+
+def task_for_function(function, in_process=False):
     ''' Create (or find, if has been created already) a task for this function. 
 
     Any package-level function that does not take any parameters can be run as a asynchronously. 
     
-    Contrary to model objects methods, functions do not need to be registered in order to be available as tasks.'''
-    return Task.objects.task_for_function(function)
+    Contrary to model objects methods, functions do not need to be registered in order to be available as tasks.
+    in_process is the same option as for register_task.'''
+    return Task.objects.task_for_function(function, in_process)
 
 
-def run_task(task):
+def run_task(task, priority=None, queue=None, tenant=None):
     ''' Runs the task. 
     
     The task will be re-run (and the previous one archived) if it has already run. 
-    In that case, the object returned by run_task will be the new task.'''
-    return Task.objects.run_task(task.pk)
+    In that case, the object returned by run_task will be the new task.
+    priority and queue override the options that the task method is registered with (see register_task).
+    The required tasks that are run too get the priority if it is higher than theirs.
+    tenant is the name of whoever the task is run for, e.g. a customer: with TASKS_FAIR_SHARE = 'tenant', 
+    the tenants share the slots fairly, whatever their number of tasks (see TASKS_FAIR_SHARE_WEIGHTS).'''
+    return Task.objects.run_task(task.pk, priority, queue, tenant)
 
 
 def cancel_task(task):
@@ -90,6 +135,42 @@ def cancel_task(task):
     return Task.objects.cancel_task(task.pk)
 
 
+def wait_for_task(task, timeout=None):
+    ''' Wait until the task is finished (cancelled, successful or unsuccessful), for timeout seconds at most.
+
+    Returns the task, loaded again, or None if it is not finished when the timeout expires.'''
+    return Task.objects.wait_for_tasks([task.pk], timeout)
+
+
+def wait_for_any(tasks, timeout=None):
+    ''' Wait until one of the tasks is finished, for timeout seconds at most.
+
+    Returns the finished task, loaded again, or None if none of them is finished when the timeout expires.'''
+    return Task.objects.wait_for_tasks([task.pk for task in tasks], timeout)
+
+
 def current_task():
-    ''' In the proces that's executing a task, the task being executed. None in all other cases.'''
-    return Task.objects.current_task
+    ''' In the proces (or the thread, for in_process tasks) that's executing a task, the task being executed. 
+    None in all other cases.'''
+    return Task.objects.get_current_task()
+
+
+def cancel_requested():
+    ''' In the task being executed, whether it has been requested to cancel. 
+
+    The tasks that run in process must check it regularly, and return when it is True.'''
+    return Task.objects.cancel_requested()
+
+
+def tail_log(task, offset=0):
+    ''' Read the log of the task from the byte offset, e.g. to follow the log of a running task. 
+
+    Returns the log text, and the offset to call tail_log with next, to read what the task writes afterwards.'''
+    from djangotasks import logstore
+    return logstore.tail(task, offset)
+
+
+def read_log_range(task, start, end=None):
+    ''' Read the log of the task between the byte offsets start and end (or the end of the log).'''
+    from djangotasks import logstore
+    return logstore.read_range(task, start, end)
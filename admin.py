@@ -32,8 +32,9 @@ from djangotasks.models import Task
 
 class TaskAdmin(admin.ModelAdmin):
     list_display = ('model', 'method', 'object_id', 'start_date', 'end_date',
-                    'duration', 'status_for_display', 'archived',)
-    list_filter = ('method',)
+                    'duration', 'resource_usage', 'status_for_display', 'archived',)
+    list_filter = ('method', 'queue',)
     search_fields = ('object_id',)
+    readonly_fields = ('log',)
     
 admin.site.register(Task, TaskAdmin)
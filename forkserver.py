@@ -0,0 +1,324 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Fork server, used to start the task processes when TASKS_FORK_SERVER is set.
+#
+# Instead of starting a new python interpreter (and loading Django) for each task, 
+# the scheduler forks a fork server once: it has Django loaded already, and forks 
+# a new child process for each task. Each task still runs in its own process, which 
+# can be cancelled by killing it.
+#
+# For each task, the scheduler opens a connection to the fork server, and sends it the task ID 
+# and the path of a FIFO that the task process writes its output to. The fork server answers 
+# with the process ID of the task, then with its exit status and resource usage when it finishes.
+#
+# The fork server is started once, by the scheduler before it starts any thread. It is not restarted
+# if it exits: the tasks are then started as new processes, as without TASKS_FORK_SERVER.
+#
+
+import os
+import sys
+import time
+import fcntl
+import errno
+import signal
+import select
+import socket
+import shutil
+import logging
+import tempfile
+import traceback
+from os.path import join
+
+LOG = logging.getLogger("djangotasks")
+
+_server_pid = None
+_server_path = None
+
+def available():
+    return os.name != 'nt' and hasattr(os, 'fork') and hasattr(os, 'mkfifo')
+
+def is_running():
+    global _server_pid
+    if _server_pid is None:
+        return False
+    try:
+        pid, _ = os.waitpid(_server_pid, os.WNOHANG)
+    except OSError:
+        pid = _server_pid
+    if pid:
+        LOG.warning("Fork server %d exited", _server_pid)
+        _server_pid = None
+        return False
+    return True
+
+def start():
+    ''' Start the fork server, if it is not running already.
+
+    This must be called by the scheduler while it is single-threaded, i.e. before it starts any task.'''
+    global _server_pid, _server_path
+    if is_running():
+        return
+    _server_path = join(tempfile.mkdtemp(prefix='djangotasks-'), 'forkserver.sock')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(_server_path)
+    listener.listen(128)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    parent_pid = os.getpid()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _serve(listener, parent_pid)
+        finally:
+            os._exit(0)
+    listener.close()
+    _server_pid = pid
+    LOG.debug("Fork server started with pid %d", pid)
+
+def stop():
+    global _server_pid
+    if _server_pid is not None:
+        try:
+            os.kill(_server_pid, signal.SIGTERM)
+            os.waitpid(_server_pid, 0)
+        except OSError:
+            pass
+        _server_pid = None
+        shutil.rmtree(os.path.dirname(_server_path), ignore_errors=True)
+
+def _readline(sock):
+    line = ''
+    while not line.endswith('\n'):
+        data = sock.recv(1)
+        if not data:
+            break
+        line += data
+    return line
+
+def _set_blocking(fd, blocking):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, (flags & ~os.O_NONBLOCK) if blocking else (flags | os.O_NONBLOCK))
+
+def _returncode(status):
+    # Same convention as subprocess.Popen.returncode
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class ForkedProcess(object):
+    ''' A task process started by the fork server. 
+
+    It has the subset of the interface of subprocess.Popen that is used to run tasks.'''
+
+    def __init__(self, task_id):
+        if not is_running():
+            raise Exception("Fork server is not running")
+        tempdir = tempfile.mkdtemp(prefix='djangotasks-')
+        try:
+            fifo_path = join(tempdir, 'output')
+            os.mkfifo(fifo_path)
+            # Opening the reading end in non-blocking mode does not wait for a writer
+            fd = os.open(fifo_path, os.O_RDONLY | os.O_NONBLOCK)
+            self._control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._control.connect(_server_path)
+            self._control.sendall('%s %s\n' % (task_id, fifo_path))
+            answer = _readline(self._control).strip()
+            if not answer.isdigit():
+                os.close(fd)
+                self._control.close()
+                raise Exception("Fork server failed to start task %s: %s" % (task_id, answer))
+        finally:
+            # Both ends of the FIFO are open now (or it failed)
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+        _set_blocking(fd, True)
+        self.pid = int(answer)
+        self.stdout = os.fdopen(fd, 'rb')
+        self.returncode = None
+        self.resource_usage = None
+
+    def _read_returncode(self):
+        answer = _readline(self._control).split()
+        self._control.close()
+        self.returncode = int(answer[1]) if answer and answer[0] == 'exit' else -1
+        if len(answer) == 7:
+            self.resource_usage = {'cpu_user': float(answer[2]),
+                                   'cpu_system': float(answer[3]),
+                                   'max_rss': int(answer[4]),
+                                   'io_input_blocks': int(answer[5]),
+                                   'io_output_blocks': int(answer[6])}
+
+    def exit_fileno(self):
+        # Readable when the exit status is sent
+        return self._control.fileno()
+
+    def poll(self):
+        if self.returncode is None:
+            readable, _, _ = select.select([self._control], [], [], 0)
+            if readable:
+                self._read_returncode()
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self._read_returncode()
+        return self.returncode
+
+
+def _serve(listener, parent_pid):
+    # Nothing should be inherited from the scheduler but what is needed here: 
+    # the database connections are dropped (each task process opens its own), 
+    # and all file descriptors are closed, in particular the pipes of the other running tasks.
+    from django.db import connections
+    stale_connections = []
+    for connection in connections.all():
+        # Do not close them properly, that would close them for the scheduler too.
+        # Also keep a reference, so that they are never garbage collected
+        stale_connections.append(connection.connection)
+        connection.connection = None
+
+    sigchld_read, sigchld_write = os.pipe()
+    _close_fds_except([0, 1, 2, listener.fileno(), sigchld_read, sigchld_write])
+    _set_blocking(sigchld_read, False)
+    _set_blocking(sigchld_write, False)
+
+    def on_sigchld(signum, frame):
+        try:
+            os.write(sigchld_write, '.')
+        except OSError:
+            pass
+    signal.signal(signal.SIGCHLD, on_sigchld)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    children = {}
+    while os.getppid() == parent_pid:
+        try:
+            readable, _, _ = select.select([listener, sigchld_read], [], [], 1.0)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = [sigchld_read]
+
+        if listener in readable:
+            connection, _ = listener.accept()
+            try:
+                pid = _fork_task(connection, 
+                                 [listener, sigchld_read, sigchld_write] + children.values())
+                children[pid] = connection
+                connection.sendall('%d\n' % pid)
+            except Exception, e:
+                try:
+                    connection.sendall('error %s\n' % str(e).replace('\n', ' '))
+                except socket.error:
+                    pass
+                connection.close()
+
+        if sigchld_read in readable:
+            try:
+                while os.read(sigchld_read, 64):
+                    pass
+            except OSError:
+                pass
+            while children:
+                try:
+                    pid, status, rusage = os.wait4(-1, os.WNOHANG)
+                except OSError:
+                    break
+                if not pid:
+                    break
+                connection = children.pop(pid, None)
+                if connection is not None:
+                    try:
+                        # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+                        max_rss = rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss
+                        connection.sendall('exit %d %r %r %d %d %d\n' % (_returncode(status), rusage.ru_utime, rusage.ru_stime, 
+                                                                         max_rss, rusage.ru_inblock, rusage.ru_oublock))
+                    except socket.error:
+                        pass
+                    connection.close()
+
+def _close_fds_except(keep_fds):
+    max_fd = 4096
+    try:
+        import resource
+        max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+        if max_fd == resource.RLIM_INFINITY:
+            max_fd = 65536
+    except (ImportError, ValueError):
+        pass
+    low = 0
+    for fd in sorted(keep_fds):
+        os.closerange(low, fd)
+        low = fd + 1
+    os.closerange(low, max_fd)
+
+def _fork_task(connection, close_in_child):
+    task_id, fifo_path = _readline(connection).strip().split(' ', 1)
+    output_fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+    _set_blocking(output_fd, True)
+    pid = os.fork()
+    if pid == 0:
+        returncode = 1
+        try:
+            try:
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                connection.close()
+                for f in close_in_child:
+                    if isinstance(f, int):
+                        os.close(f)
+                    else:
+                        f.close()
+                os.dup2(output_fd, 1)
+                os.dup2(output_fd, 2)
+                os.close(output_fd)
+                returncode = _exec_task(task_id)
+            except SystemExit, e:
+                returncode = e.code if isinstance(e.code, int) else 1
+            except:
+                traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(returncode)
+    os.close(output_fd)
+    return pid
+
+def _exec_task(task_id):
+    # Same as the runtask management command
+    from djangotasks.models import Task, LOG
+    logging.getLogger().handlers = [] # the scheduler's handlers
+    LOG.handlers = []
+    LOG.addHandler(logging.StreamHandler())
+    LOG.setLevel(logging.INFO)
+    Task.objects.exec_task(task_id)
+    return 0
@@ -0,0 +1,253 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# In-process execution of tasks, for the tasks registered with in_process=True.
+#
+# Starting a new process for a task that only takes a few milliseconds costs far more than the task itself:
+# such tasks are run by a bounded pool of threads in the scheduler process instead (see TASKS_THREAD_POOL_SIZE).
+# Their output is captured into their log, as for the other tasks.
+#
+# These tasks have no process to kill: their cancellation is cooperative, 
+# i.e. they must check djangotasks.cancel_requested() and return. They are then marked as cancelled.
+#
+# sys.stdout and sys.stderr are replaced while (and only while) such tasks run: 
+# what the other threads write goes through to the original streams.
+#
+
+from __future__ import with_statement
+
+import sys
+import time
+import Queue
+import logging
+import threading
+
+from django.conf import settings
+
+LOG = logging.getLogger("djangotasks")
+
+_local = threading.local()
+
+# Task ID -> threading.Event set when the task is requested to cancel
+_running = {}
+_running_lock = threading.Lock()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class _Capture(object):
+    ''' The output of a task, saved to its log at most once every second.'''
+
+    def __init__(self, task_id, append_log):
+        self.task_id = task_id
+        self.append_log = append_log
+        self.buf = ''
+        self.last_flush = time.time()
+        self.flushing = False
+
+    def write(self, data):
+        self.buf += data
+        if time.time() - self.last_flush > 1 and not self.flushing:
+            self.flush()
+
+    def flush(self):
+        # What is written while saving the log (e.g. log messages) is saved at the next flush
+        self.flushing = True
+        try:
+            buf, self.buf = self.buf, ''
+            self.last_flush = time.time()
+            self.append_log(self.task_id, buf)
+        finally:
+            self.flushing = False
+
+
+class _ThreadOutput(object):
+    ''' Replaces sys.stdout and sys.stderr.
+
+    What the threads running tasks write is captured, what the others write goes to the original stream.'''
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, data):
+        capture = getattr(_local, 'capture', None)
+        if capture is None:
+            self._stream.write(data)
+        else:
+            capture.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if getattr(_local, 'capture', None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class _CaptureHandler(logging.Handler):
+    ''' Sends the log messages of the threads running tasks to their output, as the runtask command does.'''
+
+    def emit(self, record):
+        capture = getattr(_local, 'capture', None)
+        if capture is not None:
+            try:
+                capture.write(self.format(record) + '\n')
+            except Exception:
+                self.handleError(record)
+
+
+class ThreadPool(object):
+    def __init__(self, size):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._busy = 0
+        self._lock = threading.Lock()
+        for i in range(size):
+            thread = threading.Thread(target=self._work, name='djangotasks-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+
+    def free_workers(self):
+        with self._lock:
+            return self.size - self._busy
+
+    def submit(self, function, *args):
+        ''' Run function in one of the threads. Returns False if they are all busy.'''
+        with self._lock:
+            if self._busy >= self.size:
+                return False
+            self._busy += 1
+        self._queue.put((function, args))
+        return True
+
+    def _work(self):
+        while True:
+            function, args = self._queue.get()
+            try:
+                function(*args)
+            except Exception:
+                LOG.exception("Exception in task thread")
+            with self._lock:
+                self._busy -= 1
+
+
+def pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            handler = _CaptureHandler()
+            handler.setLevel(logging.INFO)
+            LOG.addHandler(handler)
+            _pool = ThreadPool(getattr(settings, 'TASKS_THREAD_POOL_SIZE', 4))
+        return _pool
+
+def free_workers():
+    with _pool_lock:
+        if _pool is None:
+            # Not started until needed
+            return getattr(settings, 'TASKS_THREAD_POOL_SIZE', 4)
+    return _pool.free_workers()
+
+def _redirect_output():
+    # Called with _running_lock held, when the first task starts
+    if not isinstance(sys.stdout, _ThreadOutput):
+        sys.stdout = _ThreadOutput(sys.stdout)
+    if not isinstance(sys.stderr, _ThreadOutput):
+        sys.stderr = _ThreadOutput(sys.stderr)
+
+def _restore_output():
+    # Called with _running_lock held, when the last task stops. 
+    # Streams replaced since by someone else are left alone.
+    if isinstance(sys.stdout, _ThreadOutput):
+        sys.stdout = sys.stdout._stream
+    if isinstance(sys.stderr, _ThreadOutput):
+        sys.stderr = sys.stderr._stream
+
+def run(task_id, function, append_log):
+    ''' Call function in the current thread, for task_id, capturing its output into append_log.
+    
+    Returns the status the task finished with: "cancelled" if it was requested to cancel, 
+    otherwise "successful", or "unsuccessful" if function raised an exception, whose traceback is captured.'''
+    with _running_lock:
+        if not _running:
+            _redirect_output()
+        _running[task_id] = threading.Event()
+    _local.task_id = task_id
+    _local.capture = _Capture(task_id, append_log)
+    try:
+        try:
+            function()
+            status = "successful"
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            status = "unsuccessful"
+        if cancel_requested(task_id):
+            status = "cancelled"
+        return status
+    finally:
+        capture = _local.capture
+        _local.capture = None
+        _local.task_id = None
+        with _running_lock:
+            del _running[task_id]
+            if not _running:
+                _restore_output()
+        capture.flush()
+
+def current_task_id():
+    ''' The ID of the task run by the current thread, if any.'''
+    return getattr(_local, 'task_id', None)
+
+def is_running(task_id):
+    return task_id in _running
+
+def running_count():
+    ''' The number of tasks running in this process.'''
+    with _running_lock:
+        return len(_running)
+
+def request_cancel(task_id):
+    ''' Ask the task to cancel, if it is running in this process. Returns False otherwise.'''
+    with _running_lock:
+        event = _running.get(task_id)
+    if event is None:
+        return False
+    event.set()
+    return True
+
+def cancel_requested(task_id):
+    with _running_lock:
+        event = _running.get(task_id)
+    return event is not None and event.isSet()
@@ -0,0 +1,525 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Storage of the task logs.
+#
+# By default, the logs are stored in the database, as chunks of text that are appended 
+# as the tasks run (see TaskLogChunk).
+# With TASKS_LOG_BACKEND = 'file', the output of each task is written to a file in TASKS_LOG_DIR,
+# on the local disk of the node running the task: the database only stores the path of the file, 
+# and its length in bytes.
+#
+# The output of the tasks started by the scheduler is appended in batches, with append_many(): 
+# the number of queries does not depend on the number of tasks.
+#
+# In both cases, the log can be read incrementally by byte offsets with tail() and read_range(),
+# e.g. by a user interface that polls the log of a running task.
+#
+# The size of the logs can be limited with TASKS_LOG_HEAD_BYTES and TASKS_LOG_TAIL_BYTES: only the beginning
+# and the end of the log are kept, separated by a marker that tells how many bytes were truncated.
+# The log is truncated every time it exceeds the limits by TRUNCATION_SLACK bytes or by TASKS_LOG_TAIL_BYTES,
+# whichever is bigger, so that it is only read back once in a while. The offsets of a log change when 
+# it is truncated.
+#
+# With TASKS_LOG_COMPRESS, the logs of the tasks are compressed with zlib once they are finished,
+# and decompressed when they are read. They are compressed by a thread dedicated to it, once the status 
+# of the task has changed and its output is all saved (see task_finished). A log compressed already 
+# can still be appended to.
+#
+
+from __future__ import with_statement
+
+import os
+import mmap
+import time
+import zlib
+import Queue
+import base64
+import logging
+import threading
+from os.path import join, exists
+
+from django.conf import settings
+from django.db import transaction, connection
+
+LOG = logging.getLogger("djangotasks")
+
+TRUNCATION_MARKER = '\n[... %d bytes truncated ...]\n'
+TRUNCATION_SLACK = 64 * 1024
+COMPRESSED_SUFFIX = '.z'
+
+# Task ID -> [the length of its log in bytes, the number of bytes truncated from it], 
+# for the logs written by this process, when their size is limited
+_sizes = {}
+
+
+class DatabaseLogStore(object):
+    ''' Stores the logs as TaskLogChunk rows, one per append.'''
+
+    def __init__(self):
+        # The next sequence number of the log chunks of each task that this process writes the log of
+        self._sequences = {}
+
+    def append(self, pk, log):
+        self._append(pk, log)
+        _limit_sizes(self, {pk: log})
+
+    def _append(self, pk, log):
+        from django.db import IntegrityError
+        from djangotasks.models import Task, TaskLogChunk
+        if pk not in self._sequences:
+            # Databases without foreign keys constraints would not tell if the task does not exist
+            if not Task.objects.filter(pk=pk).exists():
+                raise Exception(("Failed to save log for task %d, task does not exist; log was:\n" % pk) + log)
+            self._sequences[pk] = self._next_sequence(pk)
+        try:
+            TaskLogChunk.objects.create(task_id=pk, sequence=self._sequences[pk], text=log)
+            self._sequences[pk] += 1
+            return
+        except IntegrityError:
+            transaction.rollback_unless_managed()
+
+        if not Task.objects.filter(pk=pk).exists():
+            del self._sequences[pk]
+            raise Exception(("Failed to save log for task %d, task does not exist; log was:\n" % pk) + log)
+        # Some log was written by another process in the meantime: append after it
+        self._sequences[pk] = self._next_sequence(pk)
+        TaskLogChunk.objects.create(task_id=pk, sequence=self._sequences[pk], text=log)
+        self._sequences[pk] += 1
+
+    def append_many(self, logs):
+        ''' Append to the logs of several tasks, a dictionary of task IDs to logs, with a single insert.
+
+        Returns the IDs of the tasks that do not exist.'''
+        from django.db import IntegrityError
+        from django.db.models import Max
+        from djangotasks.models import Task, TaskLogChunk
+        new_pks = [pk for pk in logs if pk not in self._sequences]
+        missing_pks = set()
+        if new_pks:
+            existing_pks = set(Task.objects.filter(pk__in=new_pks).values_list('pk', flat=True))
+            missing_pks = set(new_pks) - existing_pks
+            last_sequences = dict(TaskLogChunk.objects.filter(task__in=existing_pks)
+                                  .values_list('task').annotate(Max('sequence')))
+            for pk in existing_pks:
+                last_sequence = last_sequences.get(pk)
+                self._sequences[pk] = 0 if last_sequence is None else last_sequence + 1
+
+        pks = [pk for pk in logs if pk not in missing_pks]
+        if connection.features.uses_savepoints:
+            sid = transaction.savepoint()
+            try:
+                TaskLogChunk.objects.bulk_create([TaskLogChunk(task_id=pk, sequence=self._sequences[pk], text=logs[pk])
+                                                  for pk in pks])
+                transaction.savepoint_commit(sid)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                # Some log was written by another process in the meantime, or a task was deleted
+                self._append_each(pks, logs, missing_pks)
+        else:
+            # The failed insert could not be rolled back alone: each log is appended on its own
+            self._append_each(pks, logs, missing_pks)
+        for pk in pks:
+            if pk in self._sequences:
+                self._sequences[pk] += 1
+        _limit_sizes(self, dict((pk, log) for pk, log in logs.items() if pk not in missing_pks))
+        return missing_pks
+
+    def _append_each(self, pks, logs, missing_pks):
+        # Append each log after the last chunk of its task, adding the tasks that do not exist to missing_pks
+        from djangotasks.models import Task, TaskLogChunk
+        for pk in pks:
+            self._sequences.pop(pk, None)
+            if not Task.objects.filter(pk=pk).exists():
+                missing_pks.add(pk)
+                continue
+            self._sequences[pk] = self._next_sequence(pk)
+            TaskLogChunk.objects.create(task_id=pk, sequence=self._sequences[pk], text=logs[pk])
+
+    def _next_sequence(self, pk):
+        from django.db.models import Max
+        from djangotasks.models import TaskLogChunk
+        last_sequence = TaskLogChunk.objects.filter(task=pk).aggregate(Max('sequence'))['sequence__max']
+        return 0 if last_sequence is None else last_sequence + 1
+
+    def finished(self, pk):
+        self._sequences.pop(pk, None)
+        _sizes.pop(pk, None)
+
+    def _compress(self, pk):
+        # The whole log is replaced by a single compressed chunk. 
+        # What is appended afterwards is appended as uncompressed chunks, see _read
+        from djangotasks.models import TaskLogChunk
+        chunks = list(TaskLogChunk.objects.filter(task=pk).order_by('sequence').values_list('sequence', 'text', 'compressed'))
+        if not chunks:
+            return
+        log = u''.join(_chunk_text(text, compressed) for _, text, compressed in chunks)
+        # Not the chunks appended in the meantime, if any
+        TaskLogChunk.objects.filter(task=pk, sequence__lte=chunks[-1][0]).delete()
+        TaskLogChunk.objects.create(task_id=pk, sequence=0, compressed=True,
+                                    text=base64.b64encode(zlib.compress(log.encode('utf-8'))))
+
+    def read(self, task):
+        return self._read(task.pk)
+
+    def _read(self, pk):
+        from djangotasks.models import TaskLogChunk
+        return u''.join(_chunk_text(text, compressed)
+                        for text, compressed in TaskLogChunk.objects.filter(task=pk).order_by('sequence')
+                        .values_list('text', 'compressed'))
+
+    def replace(self, task, log):
+        from djangotasks.models import TaskLogChunk
+        task.log_chunks.all().delete()
+        if log:
+            TaskLogChunk.objects.create(task=task, sequence=0, text=log)
+        if task.pk in self._sequences:
+            self._sequences[task.pk] = 1 if log else 0
+
+    def delete(self, task):
+        # The chunks are deleted with the task
+        pass
+
+
+class FileLogStore(object):
+    ''' Stores the logs in one file per task.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, pk):
+        return join(self.directory, '%d.log' % pk)
+
+    def append(self, pk, log):
+        from django.db.models import F
+        from djangotasks.models import Task
+        if isinstance(log, unicode):
+            log = log.encode('utf-8')
+        if not exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another thread in the meantime
+                pass
+        path = self.path(pk)
+        if exists(path + COMPRESSED_SUFFIX):
+            self._uncompress(pk)
+        f = open(path, 'ab')
+        try:
+            f.write(log)
+        finally:
+            f.close()
+        # The length is updated once the log has been written: readers never read past it
+        rowcount = Task.objects.filter(pk=pk).update(log_path=path, log_length=F('log_length') + len(log))
+        if rowcount == 0:
+            os.remove(path)
+            raise Exception(("Failed to save log for task %d, task does not exist; log was:\n" % pk) + log)
+        _limit_sizes(self, {pk: log})
+
+    def append_many(self, logs):
+        ''' Append to the logs of several tasks, a dictionary of task IDs to logs, with a single update.
+
+        Returns the IDs of the tasks that do not exist.'''
+        from djangotasks.models import Task
+        if not exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        lengths = {}
+        for pk, log in logs.items():
+            if isinstance(log, unicode):
+                log = log.encode('utf-8')
+            if exists(self.path(pk) + COMPRESSED_SUFFIX):
+                self._uncompress(pk)
+            f = open(self.path(pk), 'ab')
+            try:
+                f.write(log)
+            finally:
+                f.close()
+            lengths[pk] = len(log)
+
+        # The lengths are updated once the logs have been written: readers never read past them
+        qn = connection.ops.quote_name
+        pks = sorted(lengths)
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = CASE %s %s END, %s = %s + CASE %s %s END WHERE %s IN (%s)' % 
+                       (qn(Task._meta.db_table), 
+                        qn('log_path'), qn('id'), ' '.join(['WHEN %s THEN %s'] * len(pks)),
+                        qn('log_length'), qn('log_length'), qn('id'), ' '.join(['WHEN %s THEN %s'] * len(pks)),
+                        qn('id'), ', '.join(['%s'] * len(pks))),
+                       sum([[pk, self.path(pk)] for pk in pks], []) + sum([[pk, lengths[pk]] for pk in pks], []) + pks)
+        transaction.commit_unless_managed()
+        missing_pks = set()
+        if cursor.rowcount != len(pks):
+            missing_pks = set(pks) - set(Task.objects.filter(pk__in=pks).values_list('pk', flat=True))
+            for pk in missing_pks:
+                os.remove(self.path(pk))
+        _limit_sizes(self, dict((pk, log) for pk, log in logs.items() if pk not in missing_pks))
+        return missing_pks
+
+    def finished(self, pk):
+        _sizes.pop(pk, None)
+
+    def _compress(self, pk):
+        from djangotasks.models import Task
+        path = self.path(pk)
+        if not exists(path):
+            return
+        f = open(path, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        f = open(path + COMPRESSED_SUFFIX, 'wb')
+        try:
+            f.write(zlib.compress(data))
+        finally:
+            f.close()
+        Task.objects.filter(pk=pk).update(log_path=path + COMPRESSED_SUFFIX, log_length=len(data))
+        os.remove(path)
+
+    def _uncompress(self, pk):
+        # Appending to a log compressed already: it is uncompressed first, 
+        # and the readers are pointed to the uncompressed file before the compressed one is removed
+        from djangotasks.models import Task
+        path = self.path(pk)
+        with open(path + COMPRESSED_SUFFIX, 'rb') as f:
+            data = zlib.decompress(f.read())
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+        Task.objects.filter(pk=pk).update(log_path=path)
+        os.remove(path + COMPRESSED_SUFFIX)
+
+    def read(self, task):
+        return _decode(_read_bytes(task.log_path, 0, task.log_length))
+
+    def replace(self, task, log):
+        from djangotasks.models import Task
+        if isinstance(log, unicode):
+            log = log.encode('utf-8')
+        if not exists(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(task.pk)
+        f = open(path, 'wb')
+        try:
+            f.write(log)
+        finally:
+            f.close()
+        if task.log_path and task.log_path != path and exists(task.log_path):
+            # Compressed
+            os.remove(task.log_path)
+        task.log_path = path
+        task.log_length = len(log)
+        Task.objects.filter(pk=task.pk).update(log_path=path, log_length=len(log))
+
+    def delete(self, task):
+        if task.log_path and exists(task.log_path):
+            os.remove(task.log_path)
+
+
+_database_store = DatabaseLogStore()
+_file_stores = {}
+
+def get_store():
+    ''' The store that the logs are written to. '''
+    if getattr(settings, 'TASKS_LOG_BACKEND', 'database') == 'file':
+        return _file_store(_log_dir())
+    return _database_store
+
+def store_for(task):
+    ''' The store that the log of the task has been written to. '''
+    if task.log_path:
+        return _file_store(os.path.dirname(task.log_path))
+    return _database_store
+
+def _file_store(directory):
+    if directory not in _file_stores:
+        _file_stores[directory] = FileLogStore(directory)
+    return _file_stores[directory]
+
+def _log_dir():
+    if hasattr(settings, 'TASKS_LOG_DIR'):
+        return settings.TASKS_LOG_DIR
+    return join(os.getenv('TEMP') if (os.name == 'nt') else '/tmp',
+                'django-tasks-logs')
+
+def _limits():
+    # The number of bytes kept at the beginning and at the end of the logs, or None if their size is not limited
+    head = getattr(settings, 'TASKS_LOG_HEAD_BYTES', None)
+    tail = getattr(settings, 'TASKS_LOG_TAIL_BYTES', None)
+    if head is None and tail is None:
+        return None
+    return head or 0, tail or 0
+
+def _compress():
+    return getattr(settings, 'TASKS_LOG_COMPRESS', False)
+
+_compressor = None
+_compressor_lock = threading.Lock()
+
+def task_finished(pk):
+    ''' To be called once the status of the task has changed to a final one, and its output is all saved.
+
+    With TASKS_LOG_COMPRESS, its log is then compressed by a thread dedicated to it, 
+    so that the scheduler and the supervisor are not delayed.'''
+    global _compressor
+    store = get_store()
+    store.finished(pk)
+    if not _compress():
+        return
+    with _compressor_lock:
+        if _compressor is None:
+            _compressor = Queue.Queue()
+            thread = threading.Thread(target=_compress_logs, args=(_compressor,), name='djangotasks-compressor')
+            thread.setDaemon(True)
+            thread.start()
+    _compressor.put((store, pk))
+
+def wait_compressed(timeout=None):
+    ''' Wait until the logs of the finished tasks are compressed, for timeout seconds at most.
+
+    Returns True if they are all compressed.'''
+    if _compressor is None:
+        return True
+    deadline = time.time() + timeout if timeout is not None else None
+    with _compressor.all_tasks_done:
+        while _compressor.unfinished_tasks:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return False
+            _compressor.all_tasks_done.wait(remaining)
+    return True
+
+def _compress_logs(queue):
+    while True:
+        store, pk = queue.get()
+        try:
+            transaction.commit_on_success(store._compress)(pk)
+        except Exception:
+            LOG.exception("Failed to compress the log of task %s", pk)
+        queue.task_done()
+
+def _limit_sizes(store, logs):
+    # Truncate the logs that exceed the limits, once logs (a dictionary of task IDs to text) have been appended to them
+    limits = _limits()
+    if limits is None:
+        return
+    head, tail = limits
+    for pk, log in logs.items():
+        size = _sizes.setdefault(pk, [0, 0])
+        size[0] += len(_encode(log))
+        if size[0] > head + tail + max(tail, TRUNCATION_SLACK):
+            _truncate(store, pk, size, head, tail)
+
+def _truncate(store, pk, size, head, tail):
+    from djangotasks.models import Task
+    task = Task.objects.get(pk=pk)
+    data = _encode(store.read(task))
+    head_data = data[:_character_start(data, head)]
+    rest = data[len(head_data):]
+    if size[1]:
+        # The marker of the previous truncation is replaced
+        rest = rest[len(TRUNCATION_MARKER % size[1]):]
+    tail_data = rest[_character_start(rest, len(rest) - tail):]
+    truncated = size[1] + len(rest) - len(tail_data)
+    data = head_data + (TRUNCATION_MARKER % truncated) + tail_data
+    store.replace(task, _decode(data))
+    size[0], size[1] = len(data), truncated
+
+def _character_start(data, offset):
+    # The offset of the first byte of the UTF-8 character at offset
+    offset = max(0, min(offset, len(data)))
+    while 0 < offset < len(data) and 0x80 <= ord(data[offset]) < 0xc0:
+        offset -= 1
+    return offset
+
+def _chunk_text(text, compressed):
+    return _decode(zlib.decompress(base64.b64decode(text))) if compressed else text
+
+def _encode(log):
+    if isinstance(log, unicode):
+        return log.encode('utf-8')
+    return log
+
+def tail(task, offset=0):
+    ''' The log of the task from the byte offset, and the offset to read the rest of the log from, 
+    once the task has written more. 
+
+    Only the new part of the log is read, for the tasks whose log is in a file. '''
+    from djangotasks.models import Task
+    log_path, log_length = Task.objects.filter(pk=task.pk).values_list('log_path', 'log_length')[0]
+    if log_path:
+        data = _read_bytes(log_path, offset, log_length)
+    else:
+        data = store_for(task).read(task).encode('utf-8')[offset:]
+    text, length = _decode_complete(data)
+    return text, offset + length
+
+def read_range(task, start, end=None):
+    ''' The log of the task, between the byte offsets start and end (or the end of the log). '''
+    if task.log_path:
+        return _decode(_read_bytes(task.log_path, start, task.log_length if end is None else min(end, task.log_length)))
+    return _decode(store_for(task).read(task).encode('utf-8')[start:end])
+
+def _read_bytes(path, start, end):
+    if end <= start or not exists(path):
+        return ''
+    if path.endswith(COMPRESSED_SUFFIX):
+        f = open(path, 'rb')
+        try:
+            return zlib.decompress(f.read())[start:end]
+        finally:
+            f.close()
+    f = open(path, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        end = min(end, size)
+        if end <= start:
+            return ''
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return mapped[start:end]
+        finally:
+            mapped.close()
+    finally:
+        f.close()
+
+def _decode(data):
+    return data.decode('utf-8', 'replace')
+
+def _decode_complete(data):
+    # A multi-byte character may not be completely written yet: it is left for the next read
+    for incomplete in range(min(4, len(data) + 1)):
+        try:
+            return data[:len(data) - incomplete].decode('utf-8'), len(data) - incomplete
+        except UnicodeDecodeError:
+            pass
+    return _decode(data), len(data)
@@ -32,6 +32,7 @@ import logging
 from signal import SIGTERM
 
 
+from optparse import make_option
 from django.core.management.base import BaseCommand
 
 from django.utils.daemonize import become_daemon
@@ -150,8 +151,16 @@ class TaskDaemon(Daemon):
         Task.objects.scheduler()
 
 class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--queues', dest='queues', default=None,
+                    help='The comma-separated names of the queues of the tasks that this node runs (all of them by default)'),
+        )
+
     def handle(self, *args, **options):
         if len(args) == 1 and args[0] in ['start', 'stop', 'restart', 'run']:
+            if options.get('queues') is not None:
+                from django.conf import settings
+                settings.TASKS_QUEUES = [queue.strip() for queue in options['queues'].split(',') if queue.strip()]
 
             if args[0] in ['start', 'restart']:
                 if _log_file():
@@ -165,4 +174,4 @@ class Command(BaseCommand):
                                              'django-taskd.pid'))
             getattr(daemon, args[0])()
         else:
-            return "Usage: %s %s start|stop|restart|run\n" % (sys.argv[0], sys.argv[1])
+            return "Usage: %s %s [--queues=queue,...] start|stop|restart|run\n" % (sys.argv[0], sys.argv[1])
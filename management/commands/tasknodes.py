@@ -0,0 +1,55 @@
+#
+# Copyright (c) 2010 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# Lists the nodes running a scheduler, with the last time they renewed their lease and their number of tasks running.
+# With node names as arguments, fails the tasks of these nodes instead: to be used when a node is known to be dead,
+# rather than waiting for its lease to expire (see TASKS_NODE_LEASE).
+#
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = "Lists the nodes running a scheduler, or fails the tasks of the given (dead) nodes"
+    args = "[node ...]"
+
+    def handle(self, *args, **options):
+
+        from djangotasks.models import Task, TaskNode, LOG
+
+        LOG.addHandler(logging.StreamHandler())
+        LOG.setLevel(logging.INFO)
+        if args:
+            for node in args:
+                LOG.info('%d tasks of node %s finished' % (Task.objects.fail_node_tasks(node), node))
+            return
+
+        for name, heartbeat in TaskNode.objects.order_by('name').values_list('name', 'heartbeat'):
+            running = Task.objects.filter(node=name, status__in=['running', 'requested_cancel']).count()
+            LOG.info('Node %s renewed its lease at %s, and has %d tasks running' % (name, heartbeat, running))
@@ -38,5 +38,6 @@ class Command(BaseCommand):
 
         LOG.addHandler(logging.StreamHandler())
         LOG.setLevel(logging.INFO)
-        for t in Task.objects.filter(status__in=['scheduled', 'running'], archived=False):
-            LOG.info('Task with id %s (%s) is %s' % (t.pk, t.method, t.status))
+        tasks = Task.objects.filter(status__in=['scheduled', 'running'], archived=False)
+        for pk, method, status in tasks.values_list('pk', 'method', 'status'):
+            LOG.info('Task with id %s (%s) is %s' % (pk, method, status))
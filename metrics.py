@@ -0,0 +1,154 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Metrics of the scheduler, in the Prometheus text exposition format.
+#
+# The scheduler records how many tasks it starts and finishes, how long they wait to start
+# (from the time they are scheduled) and run, how much log they write, and how long its passes take.
+# With TASKS_METRICS_FILE, it writes them to this file after each pass, e.g. for the textfile collector
+# of the Prometheus node exporter. The taskmetrics command prints them.
+#
+
+from __future__ import with_statement
+
+import os
+import threading
+
+from django.conf import settings
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, float('inf'))
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in zip(names, values))
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append('%s%s %s' % (self.name, _format_labels(self.labels, label_values), _format_value(value)))
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = Counter.render(self)
+        lines[1] = '# TYPE %s gauge' % self.name
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count of each bucket, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.setdefault(label_values, [[0] * len(self.buckets), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][i] += 1
+            counts[1] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for label_values, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append('%s_bucket%s %d' % (self.name, 
+                                                     _format_labels(self.labels + ('le',), label_values + (_format_value(bound),)),
+                                                     count))
+                labels = _format_labels(self.labels, label_values)
+                lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+                lines.append('%s_count%s %d' % (self.name, labels, counts[-1]))
+        return lines
+
+
+tasks_started = Counter('djangotasks_tasks_started_total', 'Tasks started by this scheduler.', ('model', 'method'))
+tasks_finished = Counter('djangotasks_tasks_finished_total', 'Tasks finished (or cancelled) by this scheduler.', 
+                         ('model', 'method', 'status'))
+wait_seconds = Histogram('djangotasks_task_wait_seconds', 'Time from scheduling a task to starting it.', ('model', 'method'))
+run_seconds = Histogram('djangotasks_task_run_seconds', 'Time from starting a task to finishing it.', ('model', 'method', 'status'))
+log_bytes = Counter('djangotasks_log_bytes_total', 'Bytes of log written for the tasks.')
+pass_seconds = Histogram('djangotasks_scheduler_pass_seconds', 'Duration of the passes of the scheduler.', 
+                         buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float('inf')))
+scheduled_tasks = Gauge('djangotasks_scheduled_tasks', 'Tasks scheduled and not started yet, on all the nodes.')
+running_tasks = Gauge('djangotasks_running_tasks', 'Tasks running on this node.')
+
+METRICS = [tasks_started, tasks_finished, wait_seconds, run_seconds, log_bytes, pass_seconds, scheduled_tasks, running_tasks]
+
+def enabled():
+    return bool(getattr(settings, 'TASKS_METRICS_FILE', None))
+
+def render():
+    ''' All the metrics, in the Prometheus text exposition format.'''
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def write():
+    ''' Write the metrics to TASKS_METRICS_FILE, replacing it at once so that readers never see a partial file.'''
+    path = settings.TASKS_METRICS_FILE
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    f = open(temp_path, 'w')
+    try:
+        f.write(render().encode('utf-8'))
+    finally:
+        f.close()
+    os.rename(temp_path, path)
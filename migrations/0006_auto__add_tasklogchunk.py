@@ -0,0 +1,62 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'TaskLogChunk'
+        db.create_table('djangotasks_tasklogchunk', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('task', self.gf('django.db.models.fields.related.ForeignKey')(related_name='log_chunks', to=orm['djangotasks.Task'])),
+            ('sequence', self.gf('django.db.models.fields.IntegerField')()),
+            ('text', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal('djangotasks', ['TaskLogChunk'])
+
+        # Adding unique constraint on 'TaskLogChunk', fields ['task', 'sequence']
+        db.create_unique('djangotasks_tasklogchunk', ['task_id', 'sequence'])
+
+
+    def backwards(self, orm):
+        # Removing unique constraint on 'TaskLogChunk', fields ['task', 'sequence']
+        db.delete_unique('djangotasks_tasklogchunk', ['task_id', 'sequence'])
+
+        # Deleting model 'TaskLogChunk'
+        db.delete_table('djangotasks_tasklogchunk')
+
+
+    models = {
+        'djangotasks.functiontask': {
+            'Meta': {'object_name': 'FunctionTask'},
+            'function_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'primary_key': 'True'}),
+            'in_process': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'})
+        },
+        'djangotasks.task': {
+            'Meta': {'object_name': 'Task'},
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'end_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log': ('django.db.models.fields.TextField', [], {'default': "''", 'null': 'True', 'blank': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'node': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'pid': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'start_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'defined'", 'max_length': '200'})
+        },
+        'djangotasks.tasklogchunk': {
+            'Meta': {'unique_together': "(('task', 'sequence'),)", 'object_name': 'TaskLogChunk'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sequence': ('django.db.models.fields.IntegerField', [], {}),
+            'task': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'log_chunks'", 'to': "orm['djangotasks.Task']"}),
+            'text': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['djangotasks']
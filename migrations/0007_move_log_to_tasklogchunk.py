@@ -0,0 +1,60 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        # The existing log of each task becomes its first log chunk
+        tasks = orm['djangotasks.Task'].objects.exclude(log__isnull=True).exclude(log='')
+        for pk, log in tasks.values_list('id', 'log').iterator():
+            orm['djangotasks.TaskLogChunk'].objects.create(task_id=pk, sequence=0, text=log)
+
+    def backwards(self, orm):
+        # Put the log chunks of each task back together
+        chunks = orm['djangotasks.TaskLogChunk'].objects.order_by('task', 'sequence')
+        task_id, log = None, []
+        for chunk_task_id, text in chunks.values_list('task_id', 'text').iterator():
+            if chunk_task_id != task_id:
+                if log:
+                    orm['djangotasks.Task'].objects.filter(pk=task_id).update(log=u''.join(log))
+                task_id, log = chunk_task_id, []
+            log.append(text)
+        if log:
+            orm['djangotasks.Task'].objects.filter(pk=task_id).update(log=u''.join(log))
+        chunks.delete()
+
+    models = {
+        'djangotasks.functiontask': {
+            'Meta': {'object_name': 'FunctionTask'},
+            'function_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'primary_key': 'True'}),
+            'in_process': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'})
+        },
+        'djangotasks.task': {
+            'Meta': {'object_name': 'Task'},
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'end_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log': ('django.db.models.fields.TextField', [], {'default': "''", 'null': 'True', 'blank': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'node': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'pid': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'start_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'defined'", 'max_length': '200'})
+        },
+        'djangotasks.tasklogchunk': {
+            'Meta': {'unique_together': "(('task', 'sequence'),)", 'object_name': 'TaskLogChunk'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sequence': ('django.db.models.fields.IntegerField', [], {}),
+            'task': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'log_chunks'", 'to': "orm['djangotasks.Task']"}),
+            'text': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['djangotasks']
+    symmetrical = True
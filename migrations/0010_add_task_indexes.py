@@ -0,0 +1,71 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+# The backends on which a partial unique index prevents two non-archived tasks for the same object and method
+PARTIAL_UNIQUE_INDEX_BACKENDS = {
+    'postgres': 'NOT archived',
+    'sqlite3': 'archived = 0',
+}
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Index for the scheduler: filter(status=..., archived=False), paged by id
+        db.create_index('djangotasks_task', ['status', 'archived', 'id'])
+
+        # Index for task_for_object, and for archiving the previous tasks in Task.save
+        db.create_index('djangotasks_task', ['model', 'method', 'object_id', 'archived'])
+
+        condition = PARTIAL_UNIQUE_INDEX_BACKENDS.get(db.backend_name)
+        if condition:
+            # Archive any duplicate left by older versions, keeping the latest task, or the index can't be created
+            db.execute('UPDATE djangotasks_task SET archived = %s WHERE archived = %s AND id NOT IN '
+                       '(SELECT MAX(id) FROM djangotasks_task WHERE archived = %s GROUP BY model, method, object_id)',
+                       [True, False, False])
+            db.execute('CREATE UNIQUE INDEX djangotasks_task_unique_not_archived '
+                       'ON djangotasks_task (model, method, object_id) WHERE ' + condition)
+
+
+    def backwards(self, orm):
+        if PARTIAL_UNIQUE_INDEX_BACKENDS.get(db.backend_name):
+            db.execute('DROP INDEX djangotasks_task_unique_not_archived')
+
+        db.delete_index('djangotasks_task', ['model', 'method', 'object_id', 'archived'])
+        db.delete_index('djangotasks_task', ['status', 'archived', 'id'])
+
+
+    models = {
+        'djangotasks.functiontask': {
+            'Meta': {'object_name': 'FunctionTask'},
+            'function_name': ('django.db.models.fields.CharField', [], {'max_length': '255', 'primary_key': 'True'}),
+            'in_process': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'})
+        },
+        'djangotasks.task': {
+            'Meta': {'object_name': 'Task'},
+            'archived': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'description': ('django.db.models.fields.CharField', [], {'default': "''", 'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'end_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'log_length': ('django.db.models.fields.BigIntegerField', [], {'default': '0'}),
+            'log_path': ('django.db.models.fields.CharField', [], {'max_length': '500', 'null': 'True', 'blank': 'True'}),
+            'method': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'node': ('django.db.models.fields.CharField', [], {'max_length': '200', 'null': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'pid': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'start_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'status': ('django.db.models.fields.CharField', [], {'default': "'defined'", 'max_length': '200'})
+        },
+        'djangotasks.tasklogchunk': {
+            'Meta': {'unique_together': "(('task', 'sequence'),)", 'object_name': 'TaskLogChunk'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'sequence': ('django.db.models.fields.IntegerField', [], {}),
+            'task': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'log_chunks'", 'to': "orm['djangotasks.Task']"}),
+            'text': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['djangotasks']
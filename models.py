@@ -26,25 +26,39 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from __future__ import with_statement
+
 import os
 import time
 import sys
 import time
 import subprocess
 import logging
+import socket
+import threading
 
 from django.db import models
 from django.conf import settings
-from datetime import datetime
+from datetime import datetime, timedelta
 from os.path import join, exists, dirname, abspath
 from collections import defaultdict
-from django.db import transaction, connection
+from django.db import transaction, connection, IntegrityError
 from django.utils.encoding import smart_unicode
 
 from djangotasks import signals
+from djangotasks import wakeup
+from djangotasks import forkserver
+from djangotasks import inprocess
+from djangotasks import logstore
+from djangotasks import statuscache
+from djangotasks import metrics
+from djangotasks import supervisor
 
 LOG = logging.getLogger("djangotasks")
 
+# The queue of the tasks, unless registered or run with a different one
+DEFAULT_QUEUE = 'default'
+
 def _get_model_name(model_class):
     return smart_unicode(model_class._meta)
 
@@ -54,6 +68,144 @@ def _get_model_class(model_name):
         raise Exception("%s is not a registered model, cannot use this task" % model_name)
     return model
 
+def _use_skip_locked():
+    # PostgreSQL 9.5+ and MySQL 8+ support SKIP LOCKED: it is used by default with PostgreSQL
+    return getattr(settings, 'TASKS_SKIP_LOCKED', getattr(connection, 'vendor', None) == 'postgresql')
+
+def _use_fork_server():
+    return getattr(settings, 'TASKS_FORK_SERVER', False) and forkserver.available()
+
+def _node_name():
+    ''' The name of this node, used for the per-node settings. Defaults to the host name.'''
+    return getattr(settings, 'TASKS_NODE_NAME', None) or socket.gethostname()
+
+def _journal_enabled():
+    return getattr(settings, 'TASKS_JOURNAL', True)
+
+def _queues():
+    # The queues that this node serves, or None for all of them
+    return getattr(settings, 'TASKS_QUEUES', None)
+
+def _queue_limits():
+    # TASKS_QUEUE_MAX_RUNNING is a dictionary of queue names to the number of tasks of the queue 
+    # that can run at the same time, on all the nodes. The other queues are only limited by the slots of the nodes
+    return getattr(settings, 'TASKS_QUEUE_MAX_RUNNING', {})
+
+# TASKS_FAIR_SHARE -> the fields of Task that define the classes of tasks that share the slots
+FAIR_SHARE_FIELDS = {
+    'model': ('model',),
+    'method': ('model', 'method'),
+    'tenant': ('tenant',),
+}
+
+def _fair_share_fields():
+    fair_share = getattr(settings, 'TASKS_FAIR_SHARE', None)
+    if fair_share is None:
+        return None
+    if fair_share not in FAIR_SHARE_FIELDS:
+        raise Exception("Unknown TASKS_FAIR_SHARE '%s', should be one of %s" % (fair_share, ', '.join(sorted(FAIR_SHARE_FIELDS))))
+    return FAIR_SHARE_FIELDS[fair_share]
+
+def _fair_share_class_name(values):
+    # The name of the class of tasks in TASKS_FAIR_SHARE_WEIGHTS, e.g. 'myapp.mymodel.mymethod' for 'method'
+    return '.'.join(values) if None not in values else None
+
+def _fair_share(streams, usage, weight, chosen):
+    ''' Weighted fair sharing of the slots between classes of tasks.
+
+    streams is a dictionary of classes to iterators of their ready tasks, in the order in which they should start,
+    and usage a dictionary of classes to their number of running tasks. 
+    The tasks are merged in the order in which they should get the slots: the task of the highest priority first,
+    then the task of the class that has the fewest running tasks for its weight, weight(class), then the oldest task.
+    The caller adds the tasks that it starts to chosen, so that they are counted in the usage of their class:
+    a class with long-running tasks gets fewer new slots.'''
+    heads = {}
+    for key, stream in streams.items():
+        task = next(stream, None)
+        if task is not None:
+            heads[key] = task
+    while heads:
+        key = min(heads, key=lambda key: (-heads[key].priority, float(usage.get(key, 0)) / weight(key), heads[key].pk))
+        task = heads[key]
+        yield task
+        if task.pk in chosen:
+            usage[key] = usage.get(key, 0) + 1
+        task = next(streams[key], None)
+        if task is None:
+            del heads[key]
+        else:
+            heads[key] = task
+
+def _byte_length(log):
+    # The size of the log once saved, in UTF-8
+    return len(log.encode('utf-8')) if isinstance(log, unicode) else len(log)
+
+def _max_running_per_node():
+    # TASKS_MAX_RUNNING_PER_NODE is either a number, or a dictionary of node names to numbers
+    # (with an optional 'default' entry, used for the nodes that are not listed)
+    max_running = getattr(settings, 'TASKS_MAX_RUNNING_PER_NODE', None)
+    if isinstance(max_running, dict):
+        max_running = max_running.get(_node_name(), max_running.get('default'))
+    if max_running is None:
+        import multiprocessing
+        try:
+            max_running = multiprocessing.cpu_count()
+        except NotImplementedError:
+            max_running = 1
+    return max_running
+
+
+class TaskDefinition(object):
+    ''' A registered task: a method of a model, and the methods of the same model that it requires.
+
+    Task definitions are immutable: registering the method again replaces its definition.
+    all_required_methods is the transitive closure of required_methods, in the order in which the tasks
+    must run (each method comes after the methods it requires), and all_required_methods_set is the same, as a set.'''
+
+    def __init__(self, model, method, documentation, required_methods, all_required_methods, options):
+        self.__dict__.update(model=model,
+                             method=method,
+                             documentation=documentation,
+                             required_methods=tuple(required_methods),
+                             all_required_methods=tuple(all_required_methods),
+                             all_required_methods_set=frozenset(all_required_methods),
+                             options=dict(options))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Task definitions cannot be modified")
+
+    def __repr__(self):
+        return 'TaskDefinition(%r, %r, required_methods=%r)' % (self.model, self.method, self.required_methods)
+
+def _compile_task_definitions(model, definitions):
+    ''' Build the TaskDefinitions of a model, from a list of (method, documentation, required methods, options).
+
+    Returns them as a SortedDict of method name to TaskDefinition, in the same order. 
+    Raises an exception if a method requires itself, directly or not.'''
+    from django.utils.datastructures import SortedDict
+    required_methods = dict((method, required) for method, _, required, _ in definitions)
+    all_required_methods = {}
+
+    def visit(method, path):
+        if method in all_required_methods:
+            return all_required_methods[method]
+        if method in path:
+            raise Exception("Task method %s of model %s requires itself: %s" % 
+                            (method, model, ' -> '.join(path[path.index(method):] + [method])))
+        closure, seen = [], set()
+        for required_method in required_methods[method]:
+            for m in visit(required_method, path + [method]) + (required_method,):
+                if m not in seen:
+                    seen.add(m)
+                    closure.append(m)
+        all_required_methods[method] = tuple(closure)
+        return all_required_methods[method]
+
+    compiled = SortedDict()
+    for method, documentation, required, options in definitions:
+        compiled[method] = TaskDefinition(model, method, documentation, required, visit(method, []), options)
+    return compiled
+
 
 class TaskManager(models.Manager):
     '''The TaskManager class is not for public use. 
@@ -68,16 +220,32 @@ class TaskManager(models.Manager):
     # it is acceptable that the tasks that already exist in the DB will still use the "old" set of dependencies,
     # then we could store the list of dependencies as a field in the Task object, 
     # and DEFINED_TASKS wouldn't be needed anymore. I'm still hesitating a little between the two solutions.
-    DEFINED_TASKS = defaultdict(list)
+    #
+    # It is a dictionary of model name to a SortedDict of method name to TaskDefinition, in the order of registration.
+    DEFINED_TASKS = {}
+
+    REGISTER_TASK_OPTIONS = ['in_process', 'priority', 'queue']
 
     # When executing a task, the current task being executed. 
     # Since only one task is executed per process, this can be a static.
     current_task = None
 
-    def register_task(self, method, documentation, *required_methods):
+    # In the scheduler, the tasks started by this process and not finished yet, 
+    # as a dictionary of task ID to process ID (the process ID is None until the process is started).
+    # Each of them uses one of the slots of this node (see TASKS_MAX_RUNNING_PER_NODE)
+    running_tasks = {}
+    _running_tasks_lock = threading.Lock()
+
+    # In the scheduler, the last time the lease of this node was renewed (see _heartbeat)
+    _last_heartbeat = None
+
+    def register_task(self, method, documentation, *required_methods, **options):
         import inspect
         if not inspect.ismethod(method):
             raise Exception(repr(method) + " is not a class method")
+        for option in options:
+            if option not in TaskManager.REGISTER_TASK_OPTIONS:
+                raise Exception("Unknown task option '%s'" % option)
         model = _get_model_name(method.im_class)
         if len(required_methods) == 1 and required_methods[0].__class__ in [list, tuple]:
             required_methods = required_methods[0]
@@ -85,32 +253,44 @@ class TaskManager(models.Manager):
         for required_method in required_methods:
             if not inspect.ismethod(required_method):
                 raise Exception(repr(required_method) + " is not a class method")
-            if required_method.im_func.__name__ not in [method_name for method_name, _, _ in TaskManager.DEFINED_TASKS[model]]:
+            if not self.get_task_definition(model, required_method.im_func.__name__):
                 raise Exception(repr(required_method) + " is not registered as a task method for model " + model)
-            
-        TaskManager.DEFINED_TASKS[model].append((method.im_func.__name__, 
-                                                 documentation if documentation else '',
-                                                 ','.join(required_method.im_func.__name__ 
-                                                          for required_method in required_methods)))
+
+        # The definitions of the model are all compiled again: registering a method again may change
+        # the dependencies of the tasks that require it. Nothing is changed if this creates a cycle
+        from django.utils.datastructures import SortedDict
+        definitions = SortedDict((definition.method, (definition.method, definition.documentation, 
+                                                      definition.required_methods, definition.options))
+                                 for definition in TaskManager.DEFINED_TASKS.get(model, {}).values())
+        definitions[method.im_func.__name__] = (method.im_func.__name__, 
+                                                documentation if documentation else '',
+                                                [required_method.im_func.__name__ for required_method in required_methods],
+                                                options)
+        TaskManager.DEFINED_TASKS[model] = _compile_task_definitions(model, definitions.values())
+
+    def get_task_definition(self, model, method):
+        ''' The TaskDefinition of the method of the model (a model name), or None if it is not registered.'''
+        return TaskManager.DEFINED_TASKS.get(model, {}).get(method)
 
     def task_for_object(self, the_class, object_id, method, status_in=None):
         model = _get_model_name(the_class)
-        if method not in [m for m, _, _ in TaskManager.DEFINED_TASKS[model]]:
+        taskdef = self.get_task_definition(model, method)
+        if not taskdef:
             raise Exception("Method '%s' not registered for model '%s'" % (method, model))
 
-        taskdef = [taskdef for taskdef in TaskManager.DEFINED_TASKS[model] 
-                   if taskdef[0] == method][0]
-
         if not status_in:
             status_in = dict(STATUS_TABLE).keys()
             
+        # Where the database supports it, a partial unique index (see migration 0010) ensures that there is
+        # only one non-archived task per object and method: the recovery below is only for the other databases
         from django.core.exceptions import MultipleObjectsReturned
         try:
             task, created = self.get_or_create(model=model, 
                                                method=method,
                                                object_id=str(object_id),
                                                status__in=status_in,
-                                               archived=False)
+                                               archived=False,
+                                               defaults={'description': taskdef.documentation})
         except MultipleObjectsReturned, e:
             LOG.exception("Integrity error: multiple non-archived tasks, should not occur. Attempting recovery by archiving all tasks for this object and method, and recreating them")
             objects = self.filter(model=model, 
@@ -122,29 +302,215 @@ class TaskManager(models.Manager):
                                                method=method,
                                                object_id=str(object_id),
                                                status__in=status_in,
-                                               archived=False)
-
-        if created:
-            self.filter(pk=task.pk).update(description=taskdef[1])
+                                               archived=False,
+                                               defaults={'description': taskdef.documentation})
 
         LOG.debug("Created task %d on model=%s, method=%s, object_id=%s", task.id, model, method, object_id)
-        return self.get(pk=task.pk)
+        return task
+
+    def tasks_for_methods(self, keys):
+        ''' The non-archived tasks for the (model name, object_id, method) keys, as a dictionary of key to task.
+
+        The existing tasks are all loaded in one query, and the missing ones are created together.'''
+        keys = set((model, smart_unicode(object_id), method) for model, object_id, method in keys)
+        tasks = self._load_tasks(keys)
+
+        missing = keys.difference(tasks)
+        if missing:
+            new_tasks = []
+            object_ids = defaultdict(list)
+            for model, object_id, method in missing:
+                taskdef = self._registered_definition(model, method)
+                new_tasks.append(Task(model=model, method=method, object_id=object_id, description=taskdef.documentation))
+                object_ids[(model, method)].append(object_id)
+            for (model, method), ids in object_ids.items():
+                self._check_objects(model, method, ids)
+            self._insert_tasks(new_tasks)
+            # Loaded again, for their IDs
+            new_tasks = self._load_tasks(missing)
+            statuscache.set_statuses(new_tasks.values())
+            tasks.update(new_tasks)
+        return tasks
+
+    def _load_tasks(self, keys):
+        from django.db.models import Q
+        methods_by_object = defaultdict(set)
+        for model, object_id, method in keys:
+            methods_by_object[(model, object_id)].add(method)
+        if not methods_by_object:
+            return {}
+
+        import operator
+        query = reduce(operator.or_, [Q(model=model, object_id=object_id, method__in=list(methods))
+                                      for (model, object_id), methods in methods_by_object.items()])
+        return dict(((task.model, task.object_id, task.method), task)
+                    for task in self.filter(query, archived=False))
+
+    def required_tasks(self, tasks, all_required=False):
+        ''' The tasks that each of the tasks requires directly, as a dictionary of task ID to list of tasks.
+
+        If all_required is True, the tasks they require directly or not, each of them once, 
+        and in the order in which they must run (see TaskDefinition.all_required_methods).
+        They are loaded for all the tasks at once, see tasks_for_methods.'''
+        keys_by_task = {}
+        for task in tasks:
+            taskdef = task._get_task_definition()
+            methods = (taskdef.all_required_methods if all_required else taskdef.required_methods) if taskdef else ()
+            keys_by_task[task.pk] = [(task.model, smart_unicode(task.object_id), method) for method in methods]
+        required_tasks = self.tasks_for_methods(key for keys in keys_by_task.values() for key in keys)
+        return dict((pk, [required_tasks[key] for key in keys]) for pk, keys in keys_by_task.items())
+
+    def statuses_for_objects(self, objects):
+        ''' The status of the current task of each registered method of the objects, 
+        as a dictionary of object to dictionary of method name to status.
+
+        The statuses are read from the cache (see statuscache), and the others from the database, in one query.
+        The tasks that do not exist yet are not created: their status is "defined".'''
+        keys_by_object = []
+        for object in objects:
+            model = _get_model_name(object.__class__)
+            keys_by_object.append((object, [(model, smart_unicode(object.pk), method) 
+                                            for method in TaskManager.DEFINED_TASKS.get(model, {}).keys()]))
+        keys = [key for _, object_keys in keys_by_object for key in object_keys]
+
+        statuses = statuscache.get_statuses(keys)
+        missing = [key for key in keys if key not in statuses]
+        if missing:
+            tasks = self._load_tasks(missing)
+            statuscache.set_statuses(tasks.values())
+            statuses.update((key, task.status) for key, task in tasks.items())
+
+        return dict((object, dict((method, statuses.get((model, object_id, method), "defined")) 
+                                  for model, object_id, method in object_keys))
+                    for object, object_keys in keys_by_object)
+
+    def tasks_for_objects(self, queryset, method):
+        ''' Create (or find) the tasks of the method for all the objects of the queryset.
+
+        The objects are processed one batch at a time (see TASKS_BULK_BATCH_SIZE), with a query to find 
+        the existing tasks and a bulk insert of the missing ones. Returns an ObjectTasks.'''
+        model = _get_model_name(queryset.model)
+        taskdef = self._registered_definition(model, method)
+        for object_ids in _batches(queryset):
+            self._bulk_create_tasks(model, taskdef, object_ids)
+        return ObjectTasks(queryset, method)
+
+    def run_tasks_for_queryset(self, queryset, method, tenant=None):
+        ''' Run the tasks of the method for all the objects of the queryset, as run_task does for one task.
+
+        The required tasks are run first, the tasks of each method being archived, created 
+        and scheduled with one statement each per batch of objects. The objects for which the task 
+        or a required task is being cancelled are skipped. Returns an ObjectTasks.'''
+        model = _get_model_name(queryset.model)
+        taskdef = self._registered_definition(model, method)
+        methods = taskdef.all_required_methods + (method,)
+        for object_ids in _batches(queryset):
+            cancelling = set(self.filter(model=model, method__in=methods, object_id__in=object_ids,
+                                         status="requested_cancel", archived=False).values_list('object_id', flat=True))
+            if cancelling:
+                LOG.warning("Tasks being cancelled, not running %s on %d objects of model %s", method, len(cancelling), model)
+                object_ids = [object_id for object_id in object_ids if object_id not in cancelling]
+            priority = taskdef.options.get('priority', 0)
+            for required_method in taskdef.all_required_methods:
+                # the required tasks that are successful already are not run again
+                self._bulk_run_tasks(model, self.get_task_definition(model, required_method), object_ids, 
+                                     ["cancelled", "unsuccessful"], priority, tenant)
+            self._bulk_run_tasks(model, taskdef, object_ids, ["cancelled", "successful", "unsuccessful"], priority, tenant)
+        wakeup.notify()
+        return ObjectTasks(queryset, method)
+
+    def _registered_definition(self, model, method):
+        taskdef = self.get_task_definition(model, method)
+        if not taskdef:
+            raise Exception("Method '%s' not registered for model '%s'" % (method, model))
+        return taskdef
+
+    def _bulk_create_tasks(self, model, taskdef, object_ids):
+        existing = set(self.filter(model=model, method=taskdef.method, object_id__in=object_ids,
+                                   archived=False).values_list('object_id', flat=True))
+        missing = [object_id for object_id in object_ids if object_id not in existing]
+        if not missing:
+            return
+        self._check_objects(model, taskdef.method, missing)
+        self._insert_tasks([Task(model=model, method=taskdef.method, object_id=object_id, 
+                                 description=taskdef.documentation)
+                            for object_id in missing])
+        statuscache.invalidate([(model, object_id, taskdef.method) for object_id in missing])
+
+    def _check_objects(self, model, method, object_ids):
+        # The tasks created in bulk are not saved one by one: what Task.save checks with _find_method, 
+        # that the method and the objects exist, is checked for all of them at once
+        the_class = _get_model_class(model)
+        getattr(the_class, method)
+        found = set(smart_unicode(pk) for pk in the_class.objects.filter(pk__in=object_ids).values_list('pk', flat=True))
+        missing = [object_id for object_id in object_ids if smart_unicode(object_id) not in found]
+        if missing:
+            raise the_class.DoesNotExist("%s matching query does not exist: pk in %s" % (the_class._meta.object_name, missing))
+
+    def _insert_tasks(self, new_tasks):
+        ''' Insert the new tasks in one statement.
+
+        Another process may create some of them at the same time: where the partial unique index 
+        on the non-archived tasks exists (see migration 0010), the insert then fails,
+        and the tasks are created one by one instead, those that exist already being kept.
+        Without savepoints, the failed insert could not be rolled back alone: they are created one by one right away.'''
+        if not connection.features.uses_savepoints:
+            self._get_or_create_tasks(new_tasks)
+            return
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create(new_tasks)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            LOG.debug("Some of %d tasks were created concurrently, creating them one by one", len(new_tasks))
+            self._get_or_create_tasks(new_tasks)
+
+    def _get_or_create_tasks(self, new_tasks):
+        for task in new_tasks:
+            self.get_or_create(model=task.model, method=task.method, object_id=task.object_id, archived=False,
+                               defaults={'description': task.description})
+
+    def _bulk_run_tasks(self, model, taskdef, object_ids, rerun_status, priority=0, tenant=None):
+        # priority is the minimum priority of the tasks, as for the required tasks in run_task
+        priority = max(taskdef.options.get('priority', 0), priority)
+        queue = taskdef.options.get('queue', DEFAULT_QUEUE)
+        tasks = self.filter(model=model, method=taskdef.method, object_id__in=object_ids, archived=False)
+        # The tasks that have run already are archived, and new ones created, then all the defined ones scheduled
+        tasks.filter(status__in=rerun_status).update(archived=True)
+        self._bulk_create_tasks(model, taskdef, object_ids)
+        pks = list(tasks.filter(status="defined").values_list('pk', flat=True))
+        self.filter(pk__in=pks, status="defined").update(status="scheduled", scheduled_date=datetime.now(), 
+                                                         priority=priority, queue=queue, tenant=tenant)
+        if _journal_enabled():
+            self._journal(pks, "defined", "scheduled")
+        statuscache.invalidate([(model, object_id, taskdef.method) for object_id in object_ids])
 
     def tasks_for_object(self, the_class, object_id):
         model = _get_model_name(the_class)
-
-        return [self.task_for_object(the_class, object_id, method)
-                for method, _, _ in TaskManager.DEFINED_TASKS[model]]
+        methods = TaskManager.DEFINED_TASKS.get(model, {}).keys()
+        tasks = self.tasks_for_methods((model, object_id, method) for method in methods)
+        return [tasks[(model, smart_unicode(object_id), method)] for method in methods]
             
-    def task_for_function(self, function):
+    def task_for_function(self, function, in_process=False):
         function_name = _to_function_name(function)
-        function_task = FunctionTask.objects.get_or_create(function_name=function_name)
+        function_task, created = FunctionTask.objects.get_or_create(function_name=function_name,
+                                                                    defaults={'in_process': in_process})
+        if not created and function_task.in_process != in_process:
+            FunctionTask.objects.filter(pk=function_name).update(in_process=in_process)
         return self.task_for_object(FunctionTask, function_name,
                                     FunctionTask.run_function_task.func_name)
 
-    def run_task(self, pk):
+    def run_task(self, pk, priority=None, queue=None, tenant=None):
         task = self.get(pk=pk)
-        self._run_required_tasks(task)
+        # By default, the priority and the queue that the method is registered with
+        taskdef = self.get_task_definition(task.model, task.method)
+        options = taskdef.options if taskdef else {}
+        if priority is None:
+            priority = options.get('priority', 0)
+        if queue is None:
+            queue = options.get('queue', DEFAULT_QUEUE)
+        self._run_required_tasks(task, priority, tenant)
         if task.status in ["scheduled", "running"]:
             return task
         if task.status in ["requested_cancel"]:        
@@ -154,13 +520,18 @@ class TaskManager(models.Manager):
                                      task.method, 
                                      task.object_id)
             
-        self.filter(pk=task.pk).update(status="scheduled")
+        self.filter(pk=task.pk).update(status="scheduled", scheduled_date=datetime.now(), priority=priority, queue=queue, 
+                                       tenant=tenant)
+        statuscache.status_changed([task.pk], "scheduled")
+        self._journal([task.pk], task.status, "scheduled")
+        wakeup.notify()
         return self.get(pk=task.pk)
 
-    def _run_required_tasks(self, task):
-        for required_task in task.get_required_tasks():
-            self._run_required_tasks(required_task)
-
+    def _run_required_tasks(self, task, priority=0, tenant=None):
+        # All the required tasks, each of them once, and after the tasks that they require in turn.
+        # They run with the priority of the task that requires them if it is higher than their own, 
+        # so that they are not left behind tasks of a lower priority
+        for required_task in self.required_tasks([task], all_required=True)[task.pk]:
             if required_task.status in ['scheduled', 'successful', 'running']:
                 continue
             
@@ -173,8 +544,15 @@ class TaskManager(models.Manager):
                                                   required_task.method, 
                                                   required_task.object_id)
 
+            previous_status = required_task.status
+            options = self.get_task_definition(required_task.model, required_task.method).options
             required_task.status = "scheduled"
+            required_task.scheduled_date = datetime.now()
+            required_task.priority = max(options.get('priority', 0), priority)
+            required_task.queue = options.get('queue', DEFAULT_QUEUE)
+            required_task.tenant = tenant
             required_task.save()
+            self._journal([required_task.pk], previous_status, "scheduled")
             
     def cancel_task(self, pk):
         task = self.get(pk=pk)
@@ -183,7 +561,8 @@ class TaskManager(models.Manager):
 
         # If the task is still scheduled, mark it requested for cancellation also:
         # if it is currently starting, that's OK, it'll stay marked as "requested_cancel" in mark_start
-        self._set_status(pk, "requested_cancel", ["scheduled", "running"])
+        if self._set_status(pk, "requested_cancel", ["scheduled", "running"]):
+            wakeup.notify()
 
 
     # The methods below are for internal use on the server. Don't use them directly.
@@ -192,11 +571,32 @@ class TaskManager(models.Manager):
                                             ["defined", "scheduled", "running", "requested_cancel"])
 
     def append_log(self, pk, log):
+        # The log is only appended to: the log already saved is not read or rewritten
         if log:
-            # not possible to make it completely atomic in Django, it seems
-            rowcount = self.filter(pk=pk).update(log=(self.get(pk=pk).log + log))
-            if rowcount == 0:
-                raise Exception(("Failed to save log for task %d, task does not exist; log was:\n" % pk) + log)
+            logstore.get_store().append(pk, log)
+            metrics.log_bytes.inc(_byte_length(log))
+
+    def append_logs(self, logs):
+        ''' Append to the logs of several tasks at once, in a single transaction.
+
+        logs is a dictionary of task IDs to the text to append to their log.'''
+        logs = dict((pk, log) for pk, log in logs.items() if log)
+        if not logs:
+            return
+        missing_pks = transaction.commit_on_success(logstore.get_store().append_many)(logs)
+        for pk in missing_pks:
+            LOG.error("Failed to save log for task %d, task does not exist; log was:\n%s", pk, logs[pk])
+        metrics.log_bytes.inc(sum(_byte_length(log) for pk, log in logs.items() if pk not in missing_pks))
+
+    def _journal(self, pks, from_status, to_status):
+        # Record the changes of status in the journal (see TaskEvent)
+        pks = list(pks)
+        if not _journal_enabled() or not pks:
+            return
+        now = datetime.now()
+        node = _node_name()
+        TaskEvent.objects.bulk_create([TaskEvent(task_id=pk, from_status=from_status, to_status=to_status, date=now, node=node)
+                                       for pk in pks])
 
     def mark_start(self, pk, pid):
         # Set the start information in all cases: That way, if it has been set
@@ -204,6 +604,7 @@ class TaskManager(models.Manager):
         rowcount = self.filter(pk=pk).update(pid=pid, start_date=datetime.now())
         if rowcount == 0:
             raise Exception("Failed to mark task with ID %d as started, task does not exist" % pk)
+        self._journal([pk], "running", "started")
 
     def _set_status(self, pk, new_status, existing_status):
         if isinstance(existing_status, str):
@@ -217,21 +618,58 @@ class TaskManager(models.Manager):
             LOG.warning('Failed to change status from %s to "%s" for task %s',
                         "or".join('"' + status + '"' for status in existing_status) if existing_status else '(any)',
                         new_status, pk)
+        else:
+            statuscache.status_changed([pk], new_status)
+            self._journal([pk], existing_status[0] if existing_status and len(existing_status) == 1 else None, new_status)
 
         return rowcount != 0
 
-    def mark_finished(self, pk, new_status, existing_status):
-        rowcount = self.filter(pk=pk).filter(status=existing_status).update(status=new_status, end_date=datetime.now())
+    def mark_finished(self, pk, new_status, existing_status, resource_usage=None):
+        # resource_usage is a dictionary of the resource usage fields of Task to their values, if known.
+        # The caller calls logstore.task_finished once the output of the task is all saved
+        rowcount = self.filter(pk=pk).filter(status=existing_status).update(status=new_status, end_date=datetime.now(),
+                                                                             **(resource_usage or {}))
         if rowcount == 0:
             LOG.warning('Failed to mark tasked as finished, from status "%s" to "%s" for task %s. May have been finished in a different thread already.',
                         existing_status, new_status, pk)
         else:
             LOG.info('Task %s finished with status "%s"', pk, new_status)
-            # Sending a task completion Signal including the task and the object
-            task = self.get(pk=pk)
-            object = _get_model_class(task.model).objects.get(pk=task.object_id)
-            signals.task_completed.send(sender=self, task=task, object=object)
+            statuscache.status_changed([pk], new_status)
+            self._journal([pk], existing_status, new_status)
+            # A slot is now free, and tasks requiring this one may be ready to run
+            wakeup.notify()
+            wakeup.task_finished()
+            # Sending a task completion Signal including the task and the object: see signals.
+            # The task is finished anyway, so that the callers finish it (its journal, its log) when a receiver fails
+            try:
+                signals.task_finished(self, pk)
+            except Exception:
+                LOG.exception("Exception in a receiver of task_completed for task %s", pk)
+        return rowcount != 0
     
+    def wait_for_tasks(self, pks, timeout=None):
+        ''' Wait until one of the tasks is finished (cancelled, successful or unsuccessful), and return it.
+        
+        Returns None if none of them is finished when the timeout (in seconds) expires.
+        The tasks that finish in this process wake the waiting threads up right away. 
+        The tasks that finish in other processes are seen by polling, more and more slowly (see TASKS_WAIT_MAX_INTERVAL).'''
+        deadline = time.time() + timeout if timeout is not None else None
+        max_interval = getattr(settings, 'TASKS_WAIT_MAX_INTERVAL', 2)
+        interval = 0.05
+        while True:
+            finished_count = wakeup.finished_count()
+            finished = list(self.filter(pk__in=pks, status__in=FINISHED_STATUS)[:1])
+            if finished:
+                return finished[0]
+            if deadline is None:
+                wait = interval
+            else:
+                wait = min(interval, deadline - time.time())
+                if wait <= 0:
+                    return None
+            wakeup.wait_finished(finished_count, wait)
+            interval = min(interval * 2, max_interval)
+
     # This is for use in the scheduler only. Don't use it directly.
     def exec_task(self, task_id):
         if self.current_task:
@@ -248,9 +686,36 @@ class TaskManager(models.Manager):
             import sys
             sys.stdout.flush()
             sys.stderr.flush()
+
+    def get_current_task(self):
+        task_id = inprocess.current_task_id()
+        if task_id is not None:
+            return self.get(pk=task_id)
+        return self.current_task
+
+    def cancel_requested(self):
+        task = self.get_current_task()
+        if not task:
+            return False
+        if inprocess.cancel_requested(task.pk):
+            return True
+        # The cancellation may have been processed by the scheduler of a different process
+        return self.filter(pk=task.pk, status__in=["requested_cancel", "cancelled"]).exists()
     
     # This is for use in the scheduler only. Don't use it directly
     def scheduler(self):
+        if _use_fork_server():
+            # Start it before any task is started, while this process has a single thread: 
+            # forking a process with several threads could deadlock the fork server on a lock held by another thread.
+            # It is never restarted: if it exits, the tasks are started as new processes instead
+            if threading.activeCount() == 1:
+                import atexit
+                forkserver.start()
+                atexit.register(forkserver.stop)
+            else:
+                LOG.warning("The scheduler does not run in a single-threaded process, the fork server is not started")
+        supervisor.install_sigchld_handler()
+
         # Run once to ensure exiting if something is wrong
         try:
             self._do_schedule()
@@ -258,43 +723,325 @@ class TaskManager(models.Manager):
             LOG.fatal("Failed to start scheduler due to exception", exc_info=1)
             return
 
+        # Wake up as soon as a task is run, cancelled or finished. 
+        # Polling is only a fallback, e.g. for changes made on other hosts.
+        # The wake-ups may come before the changes are committed: another pass follows each of them shortly
+        # The lease of this node is renewed while waiting too: whatever TASKS_POLL_INTERVAL is,
+        # the wait is no longer than TASKS_NODE_HEARTBEAT_INTERVAL (see _heartbeat)
+        poll_interval = getattr(settings, 'TASKS_POLL_INTERVAL', 30)
+        follow_up_interval = getattr(settings, 'TASKS_WAKEUP_FOLLOW_UP', 1)
+        heartbeat_interval = getattr(settings, 'TASKS_NODE_HEARTBEAT_INTERVAL', 10)
+        waiter = wakeup.Waiter()
+        retry_soon = follow_up = False
         LOG.info("Scheduler started")
-        while True:
-            # Loop time must be enough to let the threads that may have be started call mark_start
-            time.sleep(5)
-            try:
-                self._do_schedule()
-            except:
-                LOG.exception("Scheduler exception")
+        try:
+            while True:
+                deadline = time.time() + (0.5 if retry_soon else follow_up_interval if follow_up else poll_interval)
+                follow_up = waiter.wait(min(deadline - time.time(), heartbeat_interval))
+                while not follow_up and time.time() < deadline:
+                    try:
+                        self._heartbeat()
+                    except:
+                        LOG.exception("Failed to renew the lease of this node")
+                    follow_up = waiter.wait(max(min(deadline - time.time(), heartbeat_interval), 0))
+                start = time.time()
+                try:
+                    retry_soon = self._do_schedule()
+                except:
+                    LOG.exception("Scheduler exception")
+                metrics.pass_seconds.observe(time.time() - start)
+                if metrics.enabled():
+                    self._write_metrics()
+        finally:
+            waiter.close()
+
+    def _write_metrics(self):
+        try:
+            metrics.scheduled_tasks.set(self.filter(status="scheduled", archived=False).count())
+            metrics.running_tasks.set(self.slots_in_use() + inprocess.running_count())
+            metrics.write()
+        except Exception:
+            LOG.exception("Failed to write the metrics")
+
+    def slots_in_use(self):
+        ''' The number of tasks started by the scheduler of this process, and not finished yet.'''
+        return len(TaskManager.running_tasks)
+
+    def free_slots(self):
+        ''' The number of tasks that the scheduler of this process can start now.
+
+        This is limited both by TASKS_MAX_RUNNING_PER_NODE (the slots of this node)
+        and by TASKS_MAX_RUNNING (the tasks running on all the nodes).'''
+        with TaskManager._running_tasks_lock:
+            running_here = list(TaskManager.running_tasks.keys())
+        free = _max_running_per_node() - len(running_here)
+        max_running = getattr(settings, 'TASKS_MAX_RUNNING', None)
+        if max_running is not None:
+            running_elsewhere = self.filter(status="running",
+                                            archived=False).exclude(pk__in=running_here).count()
+            free = min(free, max_running - running_elsewhere - len(running_here))
+        return max(free, 0)
+
+    def _add_running_task(self, pk):
+        with TaskManager._running_tasks_lock:
+            TaskManager.running_tasks[pk] = None
+
+    def _set_running_task_pid(self, pk, pid):
+        with TaskManager._running_tasks_lock:
+            if pk in TaskManager.running_tasks:
+                TaskManager.running_tasks[pk] = pid
+
+    def _remove_running_task(self, pk):
+        with TaskManager._running_tasks_lock:
+            TaskManager.running_tasks.pop(pk, None)
 
     def _do_schedule(self):
+        ''' One pass of the scheduler. 
+
+        Returns True if the scheduler should run another pass soon, without waiting to be woken up.'''
+        retry_soon = False
+
+        self._heartbeat()
+
         # First cancel any task that needs to be cancelled...
         tasks = self.filter(status="requested_cancel",
                             archived=False)
         for task in tasks:
+            if task.pk in TaskManager.running_tasks and not task.pid:
+                # Started by this scheduler, but its process is not started yet: 
+                # it can only be cancelled once it has a pid, in a next pass
+                retry_soon = True
+                continue
+            if task.node and task.node != _node_name():
+                # Running on a different node: it has to be cancelled there
+                continue
             LOG.info("Cancelling task %d...", task.pk)
             task._do_cancel()
             LOG.info("...Task %d cancelled.", task.pk)
 
-        # ... Then start any new task
-        tasks = self.filter(status="scheduled",
-                            archived=False)
-        for task in tasks:
-            # only run if all the required tasks have been successful
-            if any(required_task.status == "unsuccessful"
-                   for required_task in task.get_required_tasks()):
-                task.status = "unsuccessful"
-                task.save()
+        # ... Then start as many new tasks as there are free slots.
+        # The tasks that run in process do not use slots, but threads of the pool
+        free_slots = self.free_slots()
+        free_threads = inprocess.free_workers()
+        if not free_slots and not free_threads:
+            LOG.debug("No free slot: %d tasks running on this node", self.slots_in_use())
+            return retry_soon
+
+        for task in self._claim_ready_tasks(free_slots, free_threads):
+            LOG.info("Starting task %s...", task.pk)
+            task.do_run(claimed=True)
+            LOG.info("...Task %s started.", task.pk)
+
+        LOG.debug("%d of %d task slots in use on this node", self.slots_in_use(), _max_running_per_node())
+        return retry_soon
+
+    def _heartbeat(self):
+        ''' Renew the lease of this node, and fail the tasks of the nodes whose lease has expired.
+
+        The tasks running on a node are finished by its scheduler only: if the node dies, they would stay running
+        (or requested to cancel) forever. Each scheduler renews the lease of its node every 
+        TASKS_NODE_HEARTBEAT_INTERVAL seconds (10 by default), in its passes and while it waits between them, and the tasks of the nodes that have not renewed theirs
+        for TASKS_NODE_LEASE seconds (120 by default) are failed by the first scheduler that sees it.
+        The lease must be much longer than the interval, and than the clock differences between the nodes.'''
+        now = datetime.now()
+        interval = getattr(settings, 'TASKS_NODE_HEARTBEAT_INTERVAL', 10)
+        if TaskManager._last_heartbeat is not None and (now - TaskManager._last_heartbeat) < timedelta(seconds=interval):
+            return
+        TaskManager._last_heartbeat = now
+        node = _node_name()
+        if not TaskNode.objects.filter(name=node).update(heartbeat=now):
+            TaskNode.objects.get_or_create(name=node, defaults={'heartbeat': now})
+
+        lease = getattr(settings, 'TASKS_NODE_LEASE', 120)
+        expired = TaskNode.objects.filter(heartbeat__lt=now - timedelta(seconds=lease)).exclude(name=node)
+        for name in expired.values_list('name', flat=True):
+            LOG.warning('Node %s has not renewed its lease for %d seconds, failing its tasks', name, lease)
+            self.fail_node_tasks(name)
+            # Unless it has come back in the meantime
+            expired.filter(name=name).delete()
+
+    def fail_node_tasks(self, node):
+        ''' Finish the tasks of a node whose scheduler is dead: the running tasks are marked as unsuccessful,
+        and those requested to cancel as cancelled. Their processes, if any, are not killed.
+
+        This is done automatically when the lease of the node expires (see _heartbeat), and by the tasknodes command.
+        Returns the number of tasks finished.'''
+        finished = 0
+        for pk, status in self.filter(node=node, status__in=["running", "requested_cancel"]).order_by('pk').values_list('pk', 'status'):
+            new_status = "cancelled" if status == "requested_cancel" else "unsuccessful"
+            self.append_log(pk, "\n[Node %s was lost, the task is marked as %s]\n" % (node, new_status))
+            if self.mark_finished(pk, new_status, status):
+                # Its output will not be saved anymore
+                logstore.task_finished(pk)
+                finished += 1
+        return finished
+
+    def _claim_ready_tasks(self, free_slots, free_threads):
+        ''' Claim the scheduled tasks that are ready to run, as many as there are free slots (or threads, 
+        for the tasks that run in process), i.e. mark them as running on this node. 
+
+        Several schedulers can run at the same time: each task is claimed by only one of them.
+        Where the database supports it, the scheduled tasks are locked with SELECT ... FOR UPDATE SKIP LOCKED
+        while they are considered, so that the other schedulers skip them and consider other ones.
+        Elsewhere, each task is claimed with a compare-and-set on its status.
+
+        Returns the claimed tasks.'''
+        if _use_skip_locked():
+            return transaction.commit_on_success(self._do_claim_ready_tasks)(free_slots, free_threads, True)
+        return self._do_claim_ready_tasks(free_slots, free_threads, False)
+
+    def _do_claim_ready_tasks(self, free_slots, free_threads, lock):
+        ready_tasks = []
+        chosen = set()
+        failed = set()
+        # The number of tasks that can still start in each of the queues that are limited (see TASKS_QUEUE_MAX_RUNNING), 
+        # and the queues that are full, whose tasks are not loaded
+        queue_limits = _queue_limits()
+        free_in_queues = dict(queue_limits)
+        if queue_limits:
+            from django.db.models import Count
+            for queue, running in (self.filter(status="running", archived=False, queue__in=queue_limits.keys())
+                                   .values_list('queue').annotate(Count('id'))):
+                free_in_queues[queue] -= running
+        full_queues = set(queue for queue, free in free_in_queues.items() if free <= 0)
+        if _fair_share_fields():
+            candidates = self._fair_share_ready_tasks(lock, full_queues, failed, chosen)
+        else:
+            candidates = self._ready_tasks(self._scheduled_tasks(lock, full_queues), failed)
+        for task in candidates:
+            if task.queue in full_queues:
                 continue
-
-            if all(required_task.status == "successful"
-                   for required_task in task.get_required_tasks()):
-                LOG.info("Starting task %s...", task.pk)
-                task.do_run()
-                LOG.info("...Task %s started.", task.pk)
-                # only start one task at a time
+            if task._runs_in_process():
+                if not free_threads:
+                    continue
+                free_threads -= 1
+            else:
+                if not free_slots:
+                    continue
+                free_slots -= 1
+            if task.queue in free_in_queues:
+                free_in_queues[task.queue] -= 1
+                if free_in_queues[task.queue] <= 0:
+                    full_queues.add(task.queue)
+            ready_tasks.append(task)
+            chosen.add(task.pk)
+            if not free_slots and not free_threads:
                 break
 
+        node = _node_name()
+        if lock:
+            # The tasks are locked by this transaction
+            self.filter(pk__in=[task.pk for task in ready_tasks]).update(status="running", node=node)
+            claimed_tasks = ready_tasks
+        else:
+            claimed_tasks = [task for task in ready_tasks
+                             if self.filter(pk=task.pk, status="scheduled").update(status="running", node=node)]
+        for task in claimed_tasks:
+            task.status = "running"
+            task.node = node
+        statuscache.status_changed([task.pk for task in claimed_tasks], "running")
+        self._journal([task.pk for task in claimed_tasks], "scheduled", "running")
+        return claimed_tasks
+
+    def _ready_tasks(self, pages, failed):
+        # The scheduled tasks whose required tasks are all successful, from the pages of scheduled tasks.
+        # The tasks with a required task that failed (or is in failed) fail too, and are added to failed
+        for page in pages:
+            # The required tasks of the whole page are loaded at once
+            required_tasks = self.required_tasks(page)
+            for task in page:
+                # only run if all the required tasks have been successful
+                if any(required_task.status == "unsuccessful" or required_task.pk in failed
+                       for required_task in required_tasks[task.pk]):
+                    task.status = "unsuccessful"
+                    task.save()
+                    self._journal([task.pk], "scheduled", "unsuccessful")
+                    failed.add(task.pk)
+                    continue
+
+                if all(required_task.status == "successful"
+                       for required_task in required_tasks[task.pk]):
+                    yield task
+
+    def _fair_share_ready_tasks(self, lock, full_queues, failed, chosen):
+        # The ready tasks, in the order in which the classes of tasks share the slots (see TASKS_FAIR_SHARE).
+        # The scheduled tasks of each class are loaded separately, TASKS_FAIR_SHARE_CANDIDATES at a time, 
+        # so that every class with scheduled tasks gets its share, however many tasks of other classes come first.
+        # The classes are read with the indexes of migration 0018
+        from django.db.models import Count
+        fields = _fair_share_fields()
+        usage = {}
+        for row in self.filter(status="running", archived=False).order_by().values_list(*fields).annotate(Count('id')):
+            usage[row[:-1]] = row[-1]
+        scheduled = self.filter(status="scheduled", archived=False)
+        if _queues() is not None:
+            scheduled = scheduled.filter(queue__in=_queues())
+        if full_queues:
+            scheduled = scheduled.exclude(queue__in=full_queues)
+        page_size = getattr(settings, 'TASKS_FAIR_SHARE_CANDIDATES', 10)
+        streams = {}
+        for values in scheduled.order_by().values_list(*fields).distinct():
+            streams[values] = self._ready_tasks(self._scheduled_tasks(lock, full_queues, dict(zip(fields, values)), page_size), 
+                                                failed)
+        weights = getattr(settings, 'TASKS_FAIR_SHARE_WEIGHTS', {})
+        return _fair_share(streams, usage, lambda values: weights.get(_fair_share_class_name(values), 1), chosen)
+
+    def _scheduled_tasks(self, lock, full_queues, class_filter=None, page_size=None):
+        # The pages of scheduled tasks of the queues served by this node, highest priority first then oldest first, 
+        # loaded one at a time, until the caller has enough. 
+        # The tasks of the queues in full_queues are skipped: the caller adds the queues that become full to it.
+        # class_filter is a dictionary of field names to values, that the tasks must have.
+        # The pages are read with the (status, archived, priority, id) index, see migration 0015
+        from django.db.models import Q
+        page_size = page_size or getattr(settings, 'TASKS_SCHEDULER_PAGE_SIZE', 100)
+        queues = _queues()
+        last_priority = last_pk = None
+        while True:
+            if lock:
+                pks = self._lock_scheduled_tasks(last_priority, last_pk, queues, full_queues, class_filter, page_size)
+                page = list(self.filter(pk__in=pks).order_by('-priority', 'pk')) if pks else []
+            else:
+                tasks = self.filter(status="scheduled", archived=False)
+                if last_pk is not None:
+                    tasks = tasks.filter(Q(priority__lt=last_priority) | Q(priority=last_priority, pk__gt=last_pk))
+                if queues is not None:
+                    tasks = tasks.filter(queue__in=queues)
+                if full_queues:
+                    tasks = tasks.exclude(queue__in=full_queues)
+                if class_filter:
+                    tasks = tasks.filter(**class_filter)
+                pks = page = list(tasks.order_by('-priority', 'pk')[:page_size])
+            if page:
+                yield page
+            if len(pks) < page_size:
+                return
+            last_priority, last_pk = page[-1].priority, page[-1].pk
+
+    def _lock_scheduled_tasks(self, last_priority, last_pk, queues, full_queues, class_filter, page_size):
+        qn = connection.ops.quote_name
+        conditions = ['%s = %%s' % qn('status'), '%s = %%s' % qn('archived')]
+        params = ["scheduled", False]
+        if last_pk is not None:
+            conditions.append('(%s < %%s OR (%s = %%s AND %s > %%s))' % (qn('priority'), qn('priority'), qn('id')))
+            params += [last_priority, last_priority, last_pk]
+        if queues is not None:
+            conditions.append('%s IN (%s)' % (qn('queue'), ', '.join(['%s'] * len(queues))) if queues else '1 = 0')
+            params += list(queues)
+        if full_queues:
+            conditions.append('%s NOT IN (%s)' % (qn('queue'), ', '.join(['%s'] * len(full_queues))))
+            params += list(full_queues)
+        for field, value in (class_filter or {}).items():
+            if value is None:
+                conditions.append('%s IS NULL' % qn(field))
+            else:
+                conditions.append('%s = %%s' % qn(field))
+                params.append(value)
+        cursor = connection.cursor()
+        cursor.execute('SELECT %s FROM %s WHERE %s ORDER BY %s DESC, %s LIMIT %%s FOR UPDATE SKIP LOCKED' % 
+                       (qn('id'), qn(Task._meta.db_table), ' AND '.join(conditions), qn('priority'), qn('id')),
+                       params + [page_size])
+        return [row[0] for row in cursor.fetchall()]
+
 STATUS_TABLE = [('defined', 'ready to run'),
                 ('scheduled', 'scheduled'),
                 ('running', 'in progress',),
@@ -304,6 +1051,8 @@ STATUS_TABLE = [('defined', 'ready to run'),
                 ('unsuccessful', 'failed'),
                 ]
 
+FINISHED_STATUS = ['cancelled', 'successful', 'unsuccessful']
+
           
 class Task(models.Model):
 
@@ -312,7 +1061,14 @@ class Task(models.Model):
     
     object_id = models.CharField(max_length=200)
     pid = models.IntegerField(null=True, blank=True)
-
+    node = models.CharField(max_length=200, null=True, blank=True) # the node of the scheduler that runs it
+
+    scheduled_date = models.DateTimeField(null=True, blank=True)
+    # The tasks of the highest priority start first, in the order in which they were scheduled
+    priority = models.IntegerField(default=0)
+    queue = models.CharField(max_length=200, default=DEFAULT_QUEUE)
+    # the tenant the task is run for, if any, e.g. for TASKS_FAIR_SHARE = 'tenant'
+    tenant = models.CharField(max_length=200, null=True, blank=True)
     start_date = models.DateTimeField(null=True, blank=True)
     end_date = models.DateTimeField(null=True, blank=True)
 
@@ -321,10 +1077,25 @@ class Task(models.Model):
                               choices=STATUS_TABLE,
                               )
     description = models.CharField(max_length=100, default='', null=True, blank=True)
-    log = models.TextField(default='', null=True, blank=True)
 
     archived = models.BooleanField(default=False) # for history
 
+    # the resources used by the process of the task, when it has finished: 
+    # CPU time in seconds, maximum resident set size in kilobytes, and blocks of file system input and output
+    cpu_user = models.FloatField(null=True, blank=True)
+    cpu_system = models.FloatField(null=True, blank=True)
+    max_rss = models.BigIntegerField(null=True, blank=True)
+    io_input_blocks = models.BigIntegerField(null=True, blank=True)
+    io_output_blocks = models.BigIntegerField(null=True, blank=True)
+
+    # The indexes on (status, archived, id) and (model, method, object_id, archived), 
+    # and the partial unique index on the non-archived tasks, are created by migration 0010.
+    # The index on (status, archived, priority DESC, id) is created by migration 0015
+
+    # when the log is stored in a file (see logstore), the file and the length of the log already written to it
+    log_path = models.CharField(max_length=500, null=True, blank=True)
+    log_length = models.BigIntegerField(default=0)
+
     def __unicode__(self):
         return u'%s - %s.%s.%s' % (self.id, self.model.split('.')[-1], self.object_id, self.method)
 
@@ -338,14 +1109,25 @@ class Task(models.Model):
     status_for_display.admin_order_field = 'status'
     status_for_display.short_description = 'Status'
 
+    def _get_log(self):
+        # Read from the log store when first read
+        if getattr(self, '_log', None) is None:
+            self._log = logstore.store_for(self).read(self) if self.pk else u''
+        return self._log
+
+    def _set_log(self, log):
+        # Replaces the whole log when saved
+        self._log = log or u''
+        self._log_replaced = True
+
+    log = property(_get_log, _set_log)
+
     def complete_log(self, directly_required_only=False):
         return '\n'.join([required_task.formatted_log() 
                           for required_task in self._unique_required_tasks(directly_required_only)])
 
     def get_required_tasks(self):
-        taskdef = self._get_task_definition()
-        return [Task.objects.task_for_object(_get_model_class(self.model), self.object_id, method)
-                for method in taskdef[2].split(',') if method] if taskdef else []
+        return Task.objects.required_tasks([self])[self.pk]
     
     def can_run(self):
         return self.status not in ["scheduled", "running", "requested_cancel", ] #"successful"
@@ -357,7 +1139,8 @@ class Task(models.Model):
             return (self.description + ' started' + ((' on ' + format(self.start_date, FORMAT)) if self.start_date else '') +
                     (("\n" + self.log) if self.log else "") + "\n" +
                     self.description + ' ' + self.status_string() + ((' on ' + format(self.end_date, FORMAT)) if self.end_date else '') +
-                    (' (%s)' % self.duration if self.duration else ''))
+                    (' (%s)' % self.duration if self.duration else '') +
+                    (' [%s]' % self.resource_usage() if self.cpu_user is not None else ''))
         elif self.status in ['running', 'requested_cancel']:
             return (self.description + ' started' + ((' on ' + format(self.start_date, FORMAT)) if self.start_date else '') +
                     (("\n" + self.log) if self.log else "") + "\n" +
@@ -365,75 +1148,145 @@ class Task(models.Model):
         else:
             return self.description + ' ' +  self.status_string()
                     
+    def resource_usage(self):
+        if self.cpu_user is None:
+            return ''
+        return 'CPU %.2fs user, %.2fs system, max RSS %.1f MB, I/O %d blocks in, %d out' % (
+            self.cpu_user, self.cpu_system or 0, (self.max_rss or 0) / 1024.0, 
+            self.io_input_blocks or 0, self.io_output_blocks or 0)
+
+    resource_usage.short_description = 'Resource usage'
+
+    def _runs_in_process(self):
+        if not hasattr(self, '_in_process'):
+            if self.model == _get_model_name(FunctionTask):
+                self._in_process = FunctionTask.objects.filter(pk=self.object_id, in_process=True).exists()
+            else:
+                taskdef = Task.objects.get_task_definition(self.model, self.method)
+                self._in_process = taskdef.options.get('in_process', False) if taskdef else False
+        return self._in_process
+
     # Only for use by the manager: do not call directly, except in tests
-    def do_run(self):
-        if self.status != "scheduled":
+    # claimed is True if the task has been claimed by the scheduler already, i.e. marked as running on this node
+    def do_run(self, claimed=False):
+        if self.status != ("running" if claimed else "scheduled"):
             raise Exception("Task not scheduled, cannot run again")
 
-        def exec_thread():
-            returncode = -1
+        if self._runs_in_process():
+            if not inprocess.pool().submit(self._run_in_process, claimed):
+                raise Exception("No free thread to run task %s" % self.pk)
+            return
+
+        # The slot is taken right away, so that the next loop of the scheduler takes this task into account
+        Task.objects._add_running_task(self.pk)
+        proc = None
+        start = None
+        try:
+            # Do not start if it's not marked as scheduled
+            # This ensures that we can have multiple schedulers
+            if not claimed and not Task.objects._set_status(self.pk, "running", "scheduled"):
+                Task.objects._remove_running_task(self.pk)
+                return
+            proc = self._start_process()
+            Task.objects.mark_start(self.pk, proc.pid)
+            start = self._record_start()
+            Task.objects._set_running_task_pid(self.pk, proc.pid)
+        except Exception, e:
+            LOG.exception("Exception in starting the process of task %s", self.pk)
+            import traceback
+            stack = traceback.format_exc()
             try:
-                # Do not start if it's not marked as scheduled
-                # This ensures that we can have multiple schedulers
-                if not Task.objects._set_status(self.pk, "running", "scheduled"):
-                    return
-                # execute the managemen utility, with the same python path as the current process
-                env = dict(os.environ)
-                env['PYTHONPATH'] = os.pathsep.join(sys.path)
-                proc = subprocess.Popen([sys.executable, 
-                                         '-c',
-                                         'from django.core.management import ManagementUtility; ManagementUtility().execute()',
-                                         'runtask', 
-                                         str(self.pk),
-                                         ],
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.STDOUT,
-                                        close_fds=(os.name != 'nt'), 
-                                        env=env)
-                Task.objects.mark_start(self.pk, proc.pid)
-                buf = ''
-                t = time.time()
-                while proc.poll() is None:
-                    line = proc.stdout.readline()
-                    buf += line
-
-                    if (time.time() - t > 1): # Save the log once every second max
-                        Task.objects.append_log(self.pk, buf)
-                        buf = ''
-                        t = time.time()
-                Task.objects.append_log(self.pk, buf)
-                
-                # Need to continue reading for a while: sometimes we miss some output
-                buf = ''
-                while True:
-                    line = proc.stdout.readline()
-                    if not line:
-                        break
-                    buf += line
-                Task.objects.append_log(self.pk, buf)
-
-                returncode = proc.returncode
-
-            except Exception, e:
-                LOG.exception("Exception in calling thread for task %s", self.pk)
-                import traceback
-                stack = traceback.format_exc()
-                try:
-                    Task.objects.append_log(self.pk, "Exception in calling thread: " + str(e) + "\n" + stack)
-                except Exception, ee:
-                    LOG.exception("Second exception while trying to save the first exception to the log for task %s!", self.pk)
+                Task.objects.append_log(self.pk, "Exception in starting the process: " + str(e) + "\n" + stack)
+            except Exception, ee:
+                LOG.exception("Second exception while trying to save the first exception to the log for task %s!", self.pk)
+            if proc is None:
+                self._process_exited(None, start)
+                return
 
-            Task.objects.mark_finished(self.pk,
-                                       "successful" if returncode == 0 else "unsuccessful",
-                                       "running")
-            
-        import thread
-        thread.start_new_thread(exec_thread, ())
+        # Its output is read, and its exit handled, by the supervisor
+        supervisor.watch(self.pk, proc, Task.objects.append_logs, 
+                         lambda proc: self._process_exited(proc, start))
+
+    def _process_exited(self, proc, start):
+        try:
+            returncode = proc.returncode if proc else -1
+            status = "successful" if returncode == 0 else "unsuccessful"
+            resource_usage = getattr(proc, 'resource_usage', None) if proc else None
+            # The output of the process is all saved by now (see supervisor.watch)
+            if Task.objects.mark_finished(self.pk, status, "running", resource_usage):
+                self._record_finish(status, start)
+                logstore.task_finished(self.pk)
+            else:
+                # e.g. cancelled
+                if resource_usage:
+                    Task.objects.filter(pk=self.pk).update(**resource_usage)
+                if Task.objects.filter(pk=self.pk, status__in=["cancelled", "successful", "unsuccessful"]).exists():
+                    logstore.task_finished(self.pk)
+        finally:
+            Task.objects._remove_running_task(self.pk)
+
+    def _run_in_process(self, claimed):
+        if not claimed and not Task.objects._set_status(self.pk, "running", "scheduled"):
+            return
+        status = "unsuccessful"
+        start = None
+        try:
+            Task.objects.mark_start(self.pk, None)
+            start = self._record_start()
+            status = inprocess.run(self.pk, self._find_method(), Task.objects.append_log)
+        except Exception, e:
+            LOG.exception("Exception in calling thread for task %s", self.pk)
+        # A task requested to cancel is marked as cancelled here, once it has stopped (see _do_cancel)
+        existing_status = "requested_cancel" if status == "cancelled" else "running"
+        if Task.objects.mark_finished(self.pk, status, existing_status):
+            self._record_finish(status, start)
+            # Its output was saved when it returned
+            logstore.task_finished(self.pk)
+
+    def _record_start(self):
+        # Returns the time the task started at, for _record_finish
+        metrics.tasks_started.inc(1, self.model, self.method)
+        if self.scheduled_date:
+            wait = datetime.now() - self.scheduled_date
+            metrics.wait_seconds.observe(wait.days * 86400 + wait.seconds + wait.microseconds / 1000000.0, 
+                                         self.model, self.method)
+        return time.time()
+
+    def _record_finish(self, status, start):
+        metrics.tasks_finished.inc(1, self.model, self.method, status)
+        if start is not None:
+            metrics.run_seconds.observe(time.time() - start, self.model, self.method, status)
+
+    def _start_process(self):
+        if _use_fork_server() and forkserver.is_running():
+            try:
+                return forkserver.ForkedProcess(self.pk)
+            except Exception:
+                LOG.exception("Failed to start task %s with the fork server, starting a new process instead", self.pk)
+
+        # execute the managemen utility, with the same python path as the current process
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        return subprocess.Popen([sys.executable, 
+                                 '-c',
+                                 'from django.core.management import ManagementUtility; ManagementUtility().execute()',
+                                 'runtask', 
+                                 str(self.pk),
+                                 ],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                close_fds=(os.name != 'nt'), 
+                                env=env)
 
     def _do_cancel(self):
         if self.status != "requested_cancel":
             raise Exception("Cannot cancel task if not requested")
 
+        if inprocess.request_cancel(self.pk):
+            # Running in a thread of this process: it will stop when it sees the request, 
+            # and be marked as cancelled then (see _run_in_process)
+            return
+
         try:
             if not self.pid:
                 # This can happen if the task was only scheduled when it was cancelled.
@@ -449,21 +1302,15 @@ class Task(models.Model):
             # could happen if the process *just finished*. Fail cleanly
             raise Exception('Failed to cancel task model=%s, method=%s, object=%s: %s' % (self.model, self.method, self.object_id, str(e)))
         finally:
-            Task.objects.mark_finished(self.pk, "cancelled", "requested_cancel")
+            if Task.objects.mark_finished(self.pk, "cancelled", "requested_cancel"):
+                self._record_finish("cancelled", None)
+                if self.pk not in TaskManager.running_tasks:
+                    # Otherwise, once its process has exited and its output is saved (see _process_exited)
+                    logstore.task_finished(self.pk)
 
     def _unique_required_tasks(self, directly_required_only=False):
-        unique_required_tasks = []
-        for required_task in self.get_required_tasks():
-            if directly_required_only:
-                if required_task not in unique_required_tasks:
-                    unique_required_tasks.append(required_task)
-            else:
-                for unique_required_task in required_task._unique_required_tasks():
-                    if unique_required_task not in unique_required_tasks:
-                        unique_required_tasks.append(unique_required_task)
-        if self not in unique_required_tasks:
-            unique_required_tasks.append(self)
-        return unique_required_tasks
+        # The required tasks (directly or not), each of them once, in the order in which they run, then this task
+        return Task.objects.required_tasks([self], all_required=not directly_required_only)[self.pk] + [self]
 
     def save(self, *args, **kwargs):
         if not self.pk:
@@ -477,15 +1324,21 @@ class Task(models.Model):
 
         super(Task, self).save(*args, **kwargs)
 
+        if not self.archived:
+            statuscache.set_statuses([self])
+
+        if getattr(self, '_log_replaced', False):
+            (logstore.store_for(self) if self.log_path else logstore.get_store()).replace(self, self._log)
+            self._log_replaced = False
+
     def _get_task_definition(self):
         if self.model not in TaskManager.DEFINED_TASKS:
             LOG.warning("A task on model=%s exists in the database, but is not defined in the code", self.model)
             return None
-        taskdefs = [taskdef for taskdef in TaskManager.DEFINED_TASKS[self.model] if taskdef[0] == self.method]
-        if len(taskdefs) == 0:
+        taskdef = Task.objects.get_task_definition(self.model, self.method)
+        if not taskdef:
             LOG.debug("A task on model=%s and method=%s exists in the database, but is not defined in the code", self.model, self.method)
-            return None
-        return taskdefs[0]
+        return taskdef
 
     def _find_method(self):
         the_class = _get_model_class(self.model)
@@ -505,6 +1358,116 @@ class Task(models.Model):
             
     objects = TaskManager()
 
+class TaskLogChunk(models.Model):
+    ''' A part of the log of a task: the log is appended to one chunk at a time, as the task runs.
+
+    With TASKS_LOG_COMPRESS, the log of a finished task is a single compressed chunk, 
+    whose text is the base64 encoding of the zlib-compressed log.'''
+    task = models.ForeignKey(Task, related_name='log_chunks')
+    sequence = models.IntegerField()
+    text = models.TextField()
+    compressed = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = (('task', 'sequence'),)
+
+def _batches(queryset):
+    # The primary keys of the objects of the queryset, as lists of object IDs of TASKS_BULK_BATCH_SIZE at most
+    batch_size = getattr(settings, 'TASKS_BULK_BATCH_SIZE', 500)
+    batch = []
+    for pk in queryset.values_list('pk', flat=True).iterator():
+        batch.append(smart_unicode(pk))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class ObjectTasks(object):
+    ''' The current tasks of a method, for the objects of a queryset.
+
+    Nothing is loaded until iterated: the tasks are then loaded one batch of objects at a time, 
+    in the order of the objects of the queryset.'''
+    def __init__(self, queryset, method):
+        self.queryset = queryset
+        self.model = _get_model_name(queryset.model)
+        self.method = method
+
+    def __iter__(self):
+        for object_ids in _batches(self.queryset):
+            tasks = dict((task.object_id, task) 
+                         for task in Task.objects.filter(model=self.model, method=self.method, 
+                                                         object_id__in=object_ids, archived=False))
+            for object_id in object_ids:
+                if object_id in tasks:
+                    yield tasks[object_id]
+
+    def count(self):
+        return sum(Task.objects.filter(model=self.model, method=self.method, 
+                                       object_id__in=object_ids, archived=False).count()
+                   for object_ids in _batches(self.queryset))
+
+class TaskEventManager(models.Manager):
+    def queue_latency(self, since=None, percentiles=(50, 95, 99), max_samples=10000):
+        ''' The percentiles of the time that the tasks waited to start, from the last time they were scheduled,
+        for each task method, as a dictionary of (model, method) to dictionary of percentile to seconds.
+
+        Only the tasks started after since (a datetime, 24 hours ago by default) are taken into account, 
+        max_samples of them at most: the last ones to start.'''
+        if since is None:
+            since = datetime.now() - timedelta(days=1)
+        started = list(self.filter(to_status="started", date__gte=since).order_by('-date', '-id').values_list(
+            'task_id', 'task__model', 'task__method', 'date')[:max_samples])
+
+        # The dates at which each of these tasks was scheduled, loaded by batches of TASKS_BULK_BATCH_SIZE tasks
+        batch_size = getattr(settings, 'TASKS_BULK_BATCH_SIZE', 500)
+        task_ids = list(set(task_id for task_id, _, _, _ in started))
+        scheduled = defaultdict(list)
+        for i in range(0, len(task_ids), batch_size):
+            for task_id, date in self.filter(to_status="scheduled", task__in=task_ids[i:i + batch_size]).values_list(
+                'task_id', 'date'):
+                scheduled[task_id].append(date)
+
+        import bisect
+        latencies = defaultdict(list)
+        for task_id, model, method, date in started:
+            dates = sorted(scheduled[task_id])
+            i = bisect.bisect_right(dates, date)
+            if i:
+                delta = date - dates[i - 1]
+                latencies[(model, method)].append(delta.days * 86400 + delta.seconds + delta.microseconds / 1000000.0)
+
+        result = {}
+        for key, values in latencies.items():
+            values.sort()
+            # nearest-rank percentiles
+            result[key] = dict((percentile, values[max(0, int(-(-percentile * len(values) // 100)) - 1)])
+                               for percentile in percentiles)
+        return result
+
+class TaskEvent(models.Model):
+    ''' A change of status of a task, in the journal of the tasks (unless TASKS_JOURNAL is False).
+
+    to_status is "started" when the process (or thread) of the task is started, its status being "running" already.
+    from_status is None when several statuses were possible.'''
+    task = models.ForeignKey(Task, related_name='events')
+    from_status = models.CharField(max_length=200, null=True, blank=True)
+    to_status = models.CharField(max_length=200)
+    date = models.DateTimeField(default=datetime.now, db_index=True)
+    node = models.CharField(max_length=200, null=True, blank=True)
+
+    objects = TaskEventManager()
+
+class TaskNode(models.Model):
+    ''' A node running a scheduler, with the last time that it renewed its lease (see TaskManager._heartbeat).'''
+    name = models.CharField(max_length=200, unique=True)
+    heartbeat = models.DateTimeField()
+
+def _delete_log(sender, instance, **kwargs):
+    logstore.store_for(instance).delete(instance)
+
+models.signals.post_delete.connect(_delete_log, sender=Task)
+
 def _to_function_name(function):
     import inspect
     if not inspect.isfunction(function):
@@ -523,6 +1486,7 @@ def _to_function(function_name):
 class FunctionTask(models.Model):
     function_name = models.CharField(max_length=255,
                                      primary_key=True)
+    in_process = models.BooleanField(default=False)
     def run_function_task(self):
         function = _to_function(self.function_name)
         return function()
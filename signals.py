@@ -26,6 +26,150 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+#
+# Signals sent by django-tasks.
+#
+# task_completed is sent when a task finishes, with the task and its object, right after it is marked as finished
+# by the thread that marked it: the exceptions of the receivers are raised to mark_finished, which logs them, 
+# the task being finished anyway. When the task is marked as finished by the supervisor, after its process exited,
+# the signals are sent by a thread started for the task instead, as the thread that used to wait for each process did, 
+# so that a slow receiver does not delay the supervision of the other processes.
+#
+# With TASKS_ASYNC_SIGNALS = True, the signals are sent by a thread dedicated to it instead, 
+# so that slow receivers do not delay the scheduler: mark_finished only puts the ID of the task in a bounded queue 
+# (see TASKS_COMPLETED_QUEUE_SIZE), and the thread loads the tasks and their objects, a batch at a time, 
+# and sends the signals. The exceptions of the receivers are then logged only.
+# The signals still queued when the process exits are sent before it exits, for TASKS_SIGNALS_EXIT_TIMEOUT seconds at most.
+#
+# The task and its object are loaded only if the signals have receivers. The object is the instance itself, 
+# loaded with the task rather than on first use: a lazy proxy fails the isinstance and type checks of the receivers, 
+# and would be loaded after the receivers of task_completed returned, when the thread sending them may be gone.
+#
+# tasks_completed is sent after task_completed, with all the tasks whose signals are sent at once, 
+# for the receivers that can process them together.
+#
+
+from __future__ import with_statement
+
+import time
+import Queue
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
 from django.dispatch import Signal
 
+LOG = logging.getLogger("djangotasks")
+
 task_completed = Signal(providing_args=["task", "object"])
+
+tasks_completed = Signal(providing_args=["tasks", "objects"])
+
+# The most tasks loaded and sent together by the dispatcher thread
+BATCH_SIZE = 100
+
+_queue = None
+_queue_lock = threading.Lock()
+
+def task_finished(sender, pk):
+    ''' Send the signals for the task that just finished, by the dispatcher thread if TASKS_ASYNC_SIGNALS is True.'''
+    if not task_completed.receivers and not tasks_completed.receivers:
+        return
+    if not getattr(settings, 'TASKS_ASYNC_SIGNALS', False):
+        from djangotasks import supervisor
+        if not supervisor.in_supervisor_thread():
+            _send([(sender, pk)], True)
+            return
+        # Not a daemon thread: the signals are sent before the process exits
+        thread = threading.Thread(target=_send_in_thread, args=([(sender, pk)],), name='djangotasks-signals-%s' % pk)
+        thread.start()
+        return
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = Queue.Queue(getattr(settings, 'TASKS_COMPLETED_QUEUE_SIZE', 1000))
+            thread = threading.Thread(target=_dispatch, args=(_queue,), name='djangotasks-signals')
+            thread.setDaemon(True)
+            thread.start()
+            import atexit
+            atexit.register(drain, getattr(settings, 'TASKS_SIGNALS_EXIT_TIMEOUT', 10))
+    # Blocks if the queue is full, until the receivers catch up
+    _queue.put((sender, pk))
+
+def drain(timeout=None):
+    ''' Wait until the signals queued by the dispatcher thread are sent, for timeout seconds at most.
+
+    Returns True if they are all sent.'''
+    if _queue is None:
+        return True
+    deadline = time.time() + timeout if timeout is not None else None
+    with _queue.all_tasks_done:
+        while _queue.unfinished_tasks:
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                LOG.warning("%d task_completed signals were not sent", _queue.unfinished_tasks)
+                return False
+            _queue.all_tasks_done.wait(remaining)
+    return True
+
+def _send_in_thread(events):
+    from django.db import connection
+    try:
+        _send(events, False)
+    except Exception:
+        LOG.exception("Failed to send the signals for %d finished tasks", len(events))
+    finally:
+        # The thread is gone after that: its connection would never be reused
+        connection.close()
+
+def _dispatch(queue):
+    while True:
+        events = [queue.get()]
+        try:
+            while len(events) < BATCH_SIZE:
+                events.append(queue.get_nowait())
+        except Queue.Empty:
+            pass
+        try:
+            _send(events, False)
+        except Exception:
+            LOG.exception("Failed to send the signals for %d finished tasks", len(events))
+        for event in events:
+            queue.task_done()
+
+def _load_objects(tasks):
+    # The objects of the tasks, with one query per model, as a dictionary of task ID to object
+    from django.utils.encoding import smart_unicode
+    from djangotasks.models import _get_model_class
+    object_ids = defaultdict(set)
+    for task in tasks:
+        object_ids[task.model].add(task.object_id)
+    objects = {}
+    for model, ids in object_ids.items():
+        for object in _get_model_class(model).objects.filter(pk__in=list(ids)):
+            objects[(model, smart_unicode(object.pk))] = object
+    return dict((task.pk, objects.get((task.model, task.object_id))) for task in tasks)
+
+def _send(events, raise_errors):
+    from djangotasks.models import Task
+    tasks = Task.objects.in_bulk([pk for _, pk in events])
+    objects = _load_objects(tasks.values())
+    sent = []
+    for sender, pk in events:
+        task = tasks.get(pk)
+        if task is None:
+            continue
+        object = objects[pk]
+        try:
+            task_completed.send(sender=sender, task=task, object=object)
+        except Exception:
+            if raise_errors:
+                raise
+            LOG.exception("Exception in a receiver of task_completed for task %s", pk)
+        sent.append((task, object))
+
+    if sent and tasks_completed.receivers:
+        tasks_completed.send(sender=events[0][0], 
+                             tasks=[task for task, _ in sent], 
+                             objects=[object for _, object in sent])
@@ -0,0 +1,102 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Cache of the statuses of the tasks, for user interfaces that poll the status of many tasks.
+#
+# It is only used with TASKS_STATUS_CACHE = True, and must then be a cache shared by all the processes
+# (e.g. memcached): the schedulers update it as the tasks change status, and the web processes read it.
+# It stores the status and ID of the current task of each (model, object_id, method), 
+# and the (model, object_id, method) of each task ID, so that it can be updated when only the ID is known.
+# Entries expire after TASKS_STATUS_CACHE_TIMEOUT seconds, in case an update is missed.
+#
+
+import hashlib
+
+from django.conf import settings
+from django.utils.encoding import smart_str
+
+PREFIX = 'djangotasks.status.'
+
+def enabled():
+    return getattr(settings, 'TASKS_STATUS_CACHE', False)
+
+def _cache():
+    from django.core.cache import cache
+    return cache
+
+def _timeout():
+    return getattr(settings, 'TASKS_STATUS_CACHE_TIMEOUT', 300)
+
+def _key(model, object_id, method):
+    # Hashed: object IDs may contain characters that are not valid in memcached keys
+    return PREFIX + hashlib.md5(smart_str(u'%s\n%s\n%s' % (model, object_id, method))).hexdigest()
+
+def _task_key(pk):
+    return PREFIX + 'task.%s' % pk
+
+def get_statuses(keys):
+    ''' The cached statuses of the (model, object_id, method) keys, as a dictionary of key to status.
+
+    The keys that are not cached are not in the dictionary.'''
+    if not enabled():
+        return {}
+    cache_keys = dict((_key(*key), key) for key in keys)
+    cached = _cache().get_many(cache_keys.keys())
+    return dict((cache_keys[cache_key], status) for cache_key, (_, status) in cached.items())
+
+def set_statuses(tasks):
+    ''' Cache the statuses of the tasks, as the current tasks of their object and method.'''
+    if not enabled():
+        return
+    values = {}
+    for task in tasks:
+        key = _key(task.model, task.object_id, task.method)
+        values[key] = (task.pk, task.status)
+        values[_task_key(task.pk)] = key
+    if values:
+        _cache().set_many(values, _timeout())
+
+def status_changed(pks, status):
+    ''' Update the status of the tasks with these IDs, when they are cached.'''
+    if not enabled() or not pks:
+        return
+    cache = _cache()
+    keys = cache.get_many([_task_key(pk) for pk in pks]).values()
+    # Unless a newer task has replaced it as the current task of its object and method
+    cached = dict((key, (pk, status)) for key, (pk, _) in cache.get_many(keys).items() if pk in pks)
+    if cached:
+        cache.set_many(cached, _timeout())
+
+def invalidate(keys):
+    ''' Remove the statuses of the (model, object_id, method) keys from the cache.'''
+    if not enabled() or not keys:
+        return
+    cache = _cache()
+    for key in keys:
+        cache.delete(_key(*key))
@@ -0,0 +1,304 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Supervision of the task processes started by the scheduler.
+#
+# A single thread watches all of them, instead of one thread per task: it reads their output 
+# in chunks as soon as it is available, without ever blocking on one of them, and reaps them when they exit.
+# It waits with poll() where available, which unlike select() supports any number of file descriptors.
+#
+# The output of all the processes is saved at once, in a single transaction, every TASKS_LOG_FLUSH_INTERVAL
+# seconds (1 by default), or as soon as TASKS_LOG_FLUSH_BYTES bytes (1MB by default) are waiting to be saved.
+#
+# A process is finished once it has exited *and* its output is closed, so that no output is lost.
+# Processes that leave children holding their output open are given EXIT_GRACE_PERIOD seconds.
+#
+# The processes started with subprocess are reaped when SIGCHLD is received, if install_sigchld_handler() 
+# could be called from the main thread, and when their output is closed otherwise. 
+# Those started by the fork server are reaped when it sends their exit status.
+#
+
+from __future__ import with_statement
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import signal
+import select
+import logging
+import threading
+import subprocess
+
+from django.conf import settings
+
+from djangotasks import forkserver
+
+LOG = logging.getLogger("djangotasks")
+
+EXIT_GRACE_PERIOD = 1.0
+READ_SIZE = 65536
+
+# Output file descriptor -> _Process
+_processes = {}
+_lock = threading.Lock()
+_thread = None
+_wakeup_read = None
+_wakeup_write = None
+_sigchld_installed = False
+
+
+def resource_usage(rusage):
+    # The resource usage fields of Task, from the result of os.wait4 or resource.getrusage.
+    # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+    return {'cpu_user': rusage.ru_utime,
+            'cpu_system': rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss // 1024 if sys.platform == 'darwin' else rusage.ru_maxrss,
+            'io_input_blocks': rusage.ru_inblock,
+            'io_output_blocks': rusage.ru_oublock}
+
+def poll(proc):
+    # Same as proc.poll(), but also sets proc.resource_usage when the process has exited, 
+    # for the processes started with subprocess (the fork server sends it for the processes it starts)
+    if not isinstance(proc, subprocess.Popen) or not hasattr(os, 'wait4'):
+        return proc.poll()
+    if proc.returncode is None:
+        try:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno != errno.ECHILD:
+                raise
+            # Reaped already, e.g. by a SIGCHLD handler other than ours
+            proc.returncode = -1
+            return proc.returncode
+        if pid:
+            proc.returncode = forkserver._returncode(status)
+            proc.resource_usage = resource_usage(rusage)
+    return proc.returncode
+
+def _set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def _wakeup():
+    try:
+        os.write(_wakeup_write, '.')
+    except OSError:
+        # Full: the supervisor has pending wake-ups already
+        pass
+
+def _init():
+    global _wakeup_read, _wakeup_write
+    if _wakeup_read is None:
+        _wakeup_read, _wakeup_write = os.pipe()
+        _set_non_blocking(_wakeup_read)
+        _set_non_blocking(_wakeup_write)
+
+def install_sigchld_handler():
+    ''' Reap the task processes as soon as they exit. 
+
+    Signal handlers can only be installed from the main thread: this does nothing if called from a different one.'''
+    global _sigchld_installed
+    if _sigchld_installed or not hasattr(signal, 'SIGCHLD'):
+        return
+    if threading.currentThread().getName() != 'MainThread':
+        return
+    with _lock:
+        _init()
+    signal.signal(signal.SIGCHLD, lambda signum, frame: _wakeup())
+    # Do not interrupt the system calls of the other threads
+    signal.siginterrupt(signal.SIGCHLD, False)
+    _sigchld_installed = True
+
+
+class _Process(object):
+    def __init__(self, task_id, proc, append_logs, on_exit):
+        self.task_id = task_id
+        self.proc = proc
+        self.append_logs = append_logs
+        self.on_exit = on_exit
+        self.fd = proc.stdout.fileno()
+        self.buf = []
+        self.size = 0
+        self.closed = False
+        self.exit_time = None
+
+    def read(self):
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
+        if data:
+            self.buf.append(data)
+            self.size += len(data)
+        else:
+            self.closed = True
+
+    def poll(self):
+        if self.exit_time is None and poll(self.proc) is not None:
+            self.exit_time = time.time()
+        return self.exit_time is not None
+
+    def take_output(self):
+        data = ''.join(self.buf)
+        self.buf = []
+        self.size = 0
+        return data
+
+
+def watch(task_id, proc, append_logs, on_exit):
+    ''' Supervise proc, the process running task_id, started with subprocess or by the fork server.
+
+    Its output is saved with append_logs(logs), where logs is a dictionary of task IDs to their new output, 
+    along with the output of the other processes watched with the same append_logs.
+    Then on_exit(proc) is called once it is finished. Both are called from the thread of the supervisor.'''
+    global _thread
+    _set_non_blocking(proc.stdout.fileno())
+    with _lock:
+        _init()
+        process = _Process(task_id, proc, append_logs, on_exit)
+        _processes[process.fd] = process
+        if _thread is None:
+            _thread = threading.Thread(target=_run, name='djangotasks-supervisor')
+            _thread.setDaemon(True)
+            _thread.start()
+    _wakeup()
+
+def in_supervisor_thread():
+    ''' True if called from the thread of the supervisor, i.e. from append_logs or on_exit.'''
+    return _thread is not None and threading.currentThread() is _thread
+
+def watched_count():
+    ''' The number of processes supervised.'''
+    with _lock:
+        return len(_processes)
+
+def _flush_interval():
+    return getattr(settings, 'TASKS_LOG_FLUSH_INTERVAL', 1.0)
+
+def _flush_bytes():
+    return getattr(settings, 'TASKS_LOG_FLUSH_BYTES', 1024 * 1024)
+
+def _flush(processes):
+    logs_by_function = {}
+    for process in processes:
+        if process.buf:
+            logs_by_function.setdefault(process.append_logs, {})[process.task_id] = process.take_output()
+    for append_logs, logs in logs_by_function.items():
+        try:
+            append_logs(logs)
+        except Exception:
+            LOG.exception("Failed to save the output of tasks %s", ", ".join(str(task_id) for task_id in sorted(logs)))
+
+def _readable(fds, timeout):
+    # The file descriptors of fds that can be read (or are closed), waiting timeout seconds at most.
+    # poll is used where available: select fails with the file descriptors above FD_SETSIZE (usually 1024),
+    # that a scheduler running many tasks uses
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            return [fd for fd, event in poller.poll(timeout * 1000)]
+        return select.select(fds, [], [], timeout)[0]
+    except select.error, e:
+        if e.args[0] != errno.EINTR:
+            raise
+        return []
+
+def _run():
+    last_flush = time.time()
+    while True:
+        try:
+            last_flush = _step(last_flush)
+        except Exception:
+            LOG.exception("Exception in the supervisor of the task processes")
+            time.sleep(1)
+
+def _step(last_flush):
+    with _lock:
+        processes = _processes.values()
+
+    readers = dict((process.fd, process) for process in processes if not process.closed)
+    # The fork server sends the exit status of the processes it started through their control socket
+    controls = dict((process.proc.exit_fileno(), process) for process in processes 
+                    if process.exit_time is None and hasattr(process.proc, 'exit_fileno'))
+    flush_interval = _flush_interval()
+    timeout = max(last_flush + flush_interval - time.time(), 0.05)
+    if any(process.closed or process.exit_time is not None for process in processes):
+        # Waiting for an exit, or for the end of the output, without notification
+        timeout = min(timeout, 0.1)
+    readable = _readable(readers.keys() + controls.keys() + [_wakeup_read], timeout)
+
+    check_exits = not _sigchld_installed
+    if _wakeup_read in readable:
+        # A new process, or SIGCHLD
+        check_exits = True
+        try:
+            while os.read(_wakeup_read, 64):
+                pass
+        except OSError:
+            pass
+
+    for fd in readable:
+        if fd in readers:
+            readers[fd].read()
+        elif fd in controls:
+            controls[fd].poll()
+
+    now = time.time()
+    finished = []
+    for process in processes:
+        if process.exit_time is None and (check_exits or process.closed) and not hasattr(process.proc, 'exit_fileno'):
+            process.poll()
+        if process.exit_time is not None and not process.closed and now - process.exit_time > EXIT_GRACE_PERIOD:
+            LOG.warning("The output of task %s is still open after its process exited, it is not read any more", process.task_id)
+            process.closed = True
+        if process.closed and process.exit_time is not None:
+            finished.append(process)
+
+    if now - last_flush >= flush_interval or sum(process.size for process in processes) >= _flush_bytes():
+        _flush(processes)
+        last_flush = now
+    elif finished:
+        # Their output is saved before they are marked as finished
+        _flush(finished)
+
+    for process in finished:
+        with _lock:
+            del _processes[process.fd]
+        process.proc.stdout.close()
+        try:
+            process.on_exit(process.proc)
+        except Exception:
+            LOG.exception("Exception when task %s finished", process.task_id)
+    return last_flush
@@ -39,7 +39,7 @@ import logging
 from os.path import join, dirname, basename, exists, join
 
 import re
-DATETIME_REGEX = re.compile('([a-zA-Z]+[.]? \d+\, \d\d\d\d at \d+(\:\d+)? [ap]\.m\. [A-Z]{1,5})|( \((\d+ hour(s)?(, )?)?(\d+ minute(s)?(, )?)?(\d+ second(s)?(, )?)?\))')
+DATETIME_REGEX = re.compile('([a-zA-Z]+[.]? \d+\, \d\d\d\d at \d+(\:\d+)? [ap]\.m\. [A-Z]{1,5})|( \((\d+ hour(s)?(, )?)?(\d+ minute(s)?(, )?)?(\d+ second(s)?(, )?)?\))|( \[CPU [^\]]*\])')
 
 from django.db import models
 
@@ -126,6 +126,18 @@ class TestModel(models.Model):
     def run_something_fast(self):
         self._run("run_something_fast", 0.1)
 
+    def run_something_in_process(self):
+        print "running in process %s" % djangotasks.current_task().method
+        self._trigger("run_something_in_process")
+
+    def run_something_in_process_until_cancelled(self):
+        print "running until cancelled"
+        self._trigger("run_something_in_process_started")
+        while not djangotasks.cancel_requested():
+            time.sleep(0.05)
+        print "cancelled"
+        self._trigger("run_something_in_process_cancelled")
+
     def check_database_settings(self):
         from django.db import connection
         print connection.settings_dict["NAME"]
@@ -175,8 +187,9 @@ class TasksTestCase(unittest.TestCase):
     assertRaises = failUnlessRaises
 
     def setUp(self):
-        from djangotasks.models import TaskManager
-        TaskManager.DEFINED_TASKS['djangotasks.testmodel'] = TEST_DEFINED_TASKS
+        for method, documentation, required_methods in TEST_DEFINED_TASKS:
+            djangotasks.register_task(getattr(TestModel, method), documentation, 
+                                      [getattr(TestModel, required_method) for required_method in required_methods.split(',') if required_method])
         
         import tempfile
         self.tempdir = tempfile.mkdtemp()
@@ -227,6 +240,133 @@ class TasksTestCase(unittest.TestCase):
         self.assertEquals("running _test_function\n", task.log)
         
 
+    def test_run_task_function_in_process(self):
+        task = djangotasks.task_for_function(_test_function, in_process=True)
+        try:
+            task = djangotasks.run_task(task)
+            with LogCheck(self, _start_message(task)):
+                Task.objects._do_schedule()
+            i = 0
+            while i < 100:
+                i += 1
+                time.sleep(0.1)
+                task = Task.objects.get(pk=task.pk)
+                if task.status == "successful":
+                    break
+
+            self.assertEquals("successful", task.status)
+            self.assertEquals(None, task.pid)
+            self.assertEquals("running _test_function\n", task.log)
+        finally:
+            djangotasks.task_for_function(_test_function)
+
+    def test_tasks_run_in_process(self):
+        djangotasks.register_task(TestModel.run_something_in_process, "Run a task in process", in_process=True)
+        task = self._task_for_object(TestModel.run_something_in_process, 'key1')
+        djangotasks.run_task(task)
+        with LogCheck(self, _start_message(task)):
+            Task.objects._do_schedule()
+        self._wait_until('key1', 'run_something_in_process')
+        time.sleep(0.3)
+        new_task = Task.objects.get(pk=task.pk)
+        self.assertEquals("successful", new_task.status)
+        self.assertEquals(None, new_task.pid)
+        self.assertEquals(u'running in process run_something_in_process\n', new_task.log)
+        # The output is only redirected while tasks run in process
+        from djangotasks import inprocess
+        self.assertFalse(isinstance(sys.stdout, inprocess._ThreadOutput))
+        self.assertFalse(isinstance(sys.stderr, inprocess._ThreadOutput))
+
+    def test_tasks_cancel_in_process(self):
+        djangotasks.register_task(TestModel.run_something_in_process_until_cancelled, "Run a task in process until cancelled", 
+                                  in_process=True)
+        task = self._task_for_object(TestModel.run_something_in_process_until_cancelled, 'key1')
+        djangotasks.run_task(task)
+        with LogCheck(self, _start_message(task)):
+            Task.objects._do_schedule()
+        self._wait_until('key1', "run_something_in_process_started")
+        djangotasks.cancel_task(task)
+        with LogCheck(self, fail_if_different=False):
+            Task.objects._do_schedule()
+        self._wait_until('key1', "run_something_in_process_cancelled")
+        time.sleep(0.3)
+        new_task = Task.objects.get(pk=task.pk)
+        self.assertEquals("cancelled", new_task.status)
+        self.assertEquals(u'running until cancelled\ncancelled\n', new_task.log)
+
+    def test_wait_for_task(self):
+        djangotasks.register_task(TestModel.run_something_in_process, "Run a task in process", in_process=True)
+        task = self._task_for_object(TestModel.run_something_in_process, 'key1')
+        other_task = self._task_for_object(TestModel.run_something_long, 'key1')
+        self.assertEquals(None, djangotasks.wait_for_task(task, 0.1))
+        task = djangotasks.run_task(task)
+        with LogCheck(self, _start_message(task)):
+            Task.objects._do_schedule()
+        finished_task = djangotasks.wait_for_any([other_task, task], 10)
+        self.assertEquals(task.pk, finished_task.pk)
+        self.assertEquals("successful", finished_task.status)
+        self.assertEquals(task.pk, djangotasks.wait_for_task(task, 0).pk)
+
+    def test_metrics(self):
+        from django.conf import settings
+        from djangotasks import metrics
+        djangotasks.register_task(TestModel.run_something_in_process, "Run a task in process", in_process=True)
+        task = self._task_for_object(TestModel.run_something_in_process, 'key1')
+        label = '{model="djangotasks.testmodel",method="run_something_in_process"}'
+        def value(name):
+            for line in metrics.render().split('\n'):
+                if line.startswith(name + ' '):
+                    return float(line.split(' ')[1])
+            return 0.0
+        started = value('djangotasks_tasks_started_total' + label)
+        waited = value('djangotasks_task_wait_seconds_count' + label)
+
+        task = djangotasks.run_task(task)
+        self.assertTrue(Task.objects.get(pk=task.pk).scheduled_date)
+        with LogCheck(self, _start_message(task)):
+            Task.objects._do_schedule()
+        djangotasks.wait_for_task(task, 10)
+        time.sleep(0.1)
+        self.assertEquals(started + 1, value('djangotasks_tasks_started_total' + label))
+        self.assertEquals(waited + 1, value('djangotasks_task_wait_seconds_count' + label))
+        self.assertTrue(value('djangotasks_tasks_finished_total{model="djangotasks.testmodel",method="run_something_in_process",status="successful"}'))
+        self.assertTrue(value('djangotasks_log_bytes_total'))
+        # In bytes, not characters
+        log_bytes = value('djangotasks_log_bytes_total')
+        Task.objects.append_log(task.pk, u'\xe9t\xe9')
+        self.assertEquals(log_bytes + 5, value('djangotasks_log_bytes_total'))
+
+        settings.TASKS_METRICS_FILE = join(self.tempdir, 'djangotasks.prom')
+        try:
+            Task.objects._write_metrics()
+            self.assertEquals(metrics.render(), open(settings.TASKS_METRICS_FILE).read())
+            self.assertTrue('\ndjangotasks_scheduled_tasks ' in metrics.render())
+        finally:
+            del settings.TASKS_METRICS_FILE
+
+    def test_task_journal(self):
+        from djangotasks.models import TaskEvent
+        djangotasks.register_task(TestModel.run_something_in_process, "Run a task in process", in_process=True)
+        task = self._task_for_object(TestModel.run_something_in_process, 'key1')
+        task = djangotasks.run_task(task)
+        with LogCheck(self, _start_message(task)):
+            Task.objects._do_schedule()
+        djangotasks.wait_for_task(task, 10)
+        self.assertEquals([('defined', 'scheduled'), ('scheduled', 'running'), ('running', 'started'), ('running', 'successful')],
+                          list(TaskEvent.objects.filter(task=task.pk).order_by('id').values_list('from_status', 'to_status')))
+
+        latency = TaskEvent.objects.queue_latency()[(TESTMODEL_NAME, 'run_something_in_process')]
+        self.assertEquals([50, 95, 99], sorted(latency.keys()))
+        self.assertTrue(0 <= latency[50] <= latency[99] < 10)
+        # Bounded by date and number of tasks
+        from datetime import datetime, timedelta
+        self.assertEquals({}, TaskEvent.objects.queue_latency(since=datetime.now() + timedelta(seconds=60)))
+        self.assertEquals({}, TaskEvent.objects.queue_latency(max_samples=0))
+
+    def test_register_task_unknown_option(self):
+        self.assertRaises(Exception("Unknown task option 'in_thread'"),
+                          djangotasks.register_task, TestModel.run_something_in_process, "Run a task in process", in_thread=True)
+
     def test__get_model_class(self):
         from djangotasks.models import _get_model_class
         self.assertEquals(TestModel, _get_model_class('djangotasks.testmodel'))
@@ -281,13 +421,31 @@ class TasksTestCase(unittest.TestCase):
             djangotasks.register_task(MyClass.mymethod3, None, MyClass.mymethod1, MyClass.mymethod2)
             djangotasks.register_task(MyClass.mymethod4, None, [MyClass.mymethod1, MyClass.mymethod2])
             djangotasks.register_task(MyClass.mymethod5, None, (MyClass.mymethod1, MyClass.mymethod2))
-            self.assertEquals([('mymethod1', 'Some documentation', ''), 
-                               ('mymethod2', 'Some other documentation', 'mymethod1'),
-                               ('mymethod3', '', 'mymethod1,mymethod2'),
-                               ('mymethod4', '', 'mymethod1,mymethod2'),
-                               ('mymethod5', '', 'mymethod1,mymethod2'),                               
+            self.assertEquals([('mymethod1', 'Some documentation', ()), 
+                               ('mymethod2', 'Some other documentation', ('mymethod1',)),
+                               ('mymethod3', '', ('mymethod1', 'mymethod2')),
+                               ('mymethod4', '', ('mymethod1', 'mymethod2')),
+                               ('mymethod5', '', ('mymethod1', 'mymethod2')),                               
                               ],
-                              TaskManager.DEFINED_TASKS['djangotasks.myclass'])
+                              [(taskdef.method, taskdef.documentation, taskdef.required_methods)
+                               for taskdef in TaskManager.DEFINED_TASKS['djangotasks.myclass'].values()])
+            self.assertEquals(('mymethod1', 'mymethod2'), 
+                              Task.objects.get_task_definition('djangotasks.myclass', 'mymethod3').all_required_methods)
+
+            # Registering a method again replaces its definition, and changes the dependencies of the methods that require it
+            djangotasks.register_task(MyClass.mymethod2, None)
+            djangotasks.register_task(MyClass.mymethod1, None, MyClass.mymethod2)
+            self.assertEquals(('mymethod2',), 
+                              Task.objects.get_task_definition('djangotasks.myclass', 'mymethod1').required_methods)
+            self.assertEquals(('mymethod2', 'mymethod1'), 
+                              Task.objects.get_task_definition('djangotasks.myclass', 'mymethod3').all_required_methods)
+            self.assertEquals(['mymethod1', 'mymethod2', 'mymethod3', 'mymethod4', 'mymethod5'],
+                              TaskManager.DEFINED_TASKS['djangotasks.myclass'].keys())
+
+            # ... unless it creates a cycle
+            self.assertRaises(Exception("Task method mymethod1 of model djangotasks.myclass requires itself: mymethod1 -> mymethod2 -> mymethod3 -> mymethod1"),
+                              djangotasks.register_task, MyClass.mymethod2, None, MyClass.mymethod3)
+            self.assertEquals((), Task.objects.get_task_definition('djangotasks.myclass', 'mymethod2').required_methods)
         finally:
             del TaskManager.DEFINED_TASKS['djangotasks.myclass']
 
@@ -312,6 +470,59 @@ class TasksTestCase(unittest.TestCase):
         self._check_running('key1', task, None, 'run_something_long_2',
                             u'running run_something_long_1\nrunning run_something_long_2\n')
 
+    def test_tasks_resource_usage(self):
+        task = self._task_for_object(TestModel.run_something_fast, 'key1')
+        djangotasks.run_task(task)
+        self._check_running('key1', task, None, 'run_something_fast')
+        task = Task.objects.get(pk=task.pk)
+        self.assertTrue(task.cpu_user > 0)
+        self.assertTrue(task.cpu_system is not None)
+        self.assertTrue(task.max_rss > 0)
+        self.assertTrue(task.resource_usage().startswith('CPU '))
+        self.assertTrue((' [%s]' % task.resource_usage()) in task.formatted_log())
+
+        # In kilobytes on all platforms
+        from djangotasks import supervisor
+        class Rusage(object):
+            ru_utime, ru_stime, ru_maxrss, ru_inblock, ru_oublock = 1.0, 0.5, 2048000, 0, 0
+        platform = sys.platform
+        try:
+            sys.platform = 'darwin'
+            self.assertEquals(2000, supervisor.resource_usage(Rusage())['max_rss'])
+            sys.platform = 'linux2'
+            self.assertEquals(2048000, supervisor.resource_usage(Rusage())['max_rss'])
+        finally:
+            sys.platform = platform
+
+    def test_supervisor_high_file_descriptors(self):
+        # Above FD_SETSIZE, that select does not support
+        import resource
+        from djangotasks import supervisor
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 1500:
+            return
+        read_fd, write_fd = os.pipe()
+        os.dup2(read_fd, 1500)
+        try:
+            self.assertEquals([], supervisor._readable([1500], 0.1))
+            os.write(write_fd, 'x')
+            self.assertEquals([1500], supervisor._readable([1500], 1))
+        finally:
+            for fd in [read_fd, write_fd, 1500]:
+                os.close(fd)
+
+    def test_tasks_supervised_by_one_thread(self):
+        import threading
+        from djangotasks import supervisor
+        task1 = self._task_for_object(TestModel.run_something_fast, 'key1')
+        task2 = self._task_for_object(TestModel.run_something_fast, 'key2')
+        djangotasks.run_task(task1)
+        self._check_running('key1', task1, None, 'run_something_fast', u'running run_something_fast\n')
+        djangotasks.run_task(task2)
+        self._check_running('key2', task2, None, 'run_something_fast', u'running run_something_fast\n')
+        self.assertEquals(1, len([thread for thread in threading.enumerate()
+                                  if thread.getName() == 'djangotasks-supervisor']))
+        self.assertEquals(0, supervisor.watched_count())
+
     def test_tasks_run_check_database(self):
         task = self._task_for_object(TestModel.check_database_settings, 'key1')
         djangotasks.run_task(task)
@@ -359,6 +570,594 @@ class TasksTestCase(unittest.TestCase):
         self.assertEquals("cancelled", new_task.status)            
         self.assertEquals("", new_task.log)
 
+    def test_tasks_run_concurrently(self):
+        from django.conf import settings
+        tasks = [self._task_for_object(TestModel.run_something_fast, key) for key in ['key1', 'key2', 'key3']]
+        for task in tasks:
+            djangotasks.run_task(task)
+
+        settings.TASKS_MAX_RUNNING_PER_NODE = 2
+        try:
+            output_check = LogCheck(self, fail_if_different=False)
+            with output_check:
+                Task.objects._do_schedule()
+            self.assertEquals(2, output_check.log.getvalue().count("INFO: Starting task"))
+            self.assertEquals(2, Task.objects.slots_in_use())
+            self.assertEquals(0, Task.objects.free_slots())
+
+            self._wait_until('key1', 'run_something_fast')
+            self._wait_until('key2', 'run_something_fast')
+            time.sleep(0.5)
+            self.assertEquals(0, Task.objects.slots_in_use())
+            with LogCheck(self, _start_message(tasks[2])):
+                Task.objects._do_schedule()
+            self._wait_until('key3', 'run_something_fast')
+            time.sleep(0.5)
+            for task in tasks:
+                self._assert_status("successful", task)
+        finally:
+            del settings.TASKS_MAX_RUNNING_PER_NODE
+
+    def test_tasks_max_running(self):
+        from django.conf import settings
+        task = self._task_for_object(TestModel.run_something_fast, 'key1')
+        djangotasks.run_task(task)
+        settings.TASKS_MAX_RUNNING = 0
+        try:
+            self.assertEquals(0, Task.objects.free_slots())
+            with LogCheck(self):
+                Task.objects._do_schedule()
+            self._assert_status("scheduled", task)
+        finally:
+            del settings.TASKS_MAX_RUNNING
+
+    def test_claim_ready_tasks(self):
+        from django.conf import settings
+        required_task = self._task_for_object(TestModel.run_something_long, 'key1')
+        task = self._task_for_object(TestModel.run_something_with_required, 'key1')
+        other_task = self._task_for_object(TestModel.run_something_fast, 'key1')
+        djangotasks.run_task(task)
+        djangotasks.run_task(other_task)
+        settings.TASKS_NODE_NAME = 'node1'
+        try:
+            # Only the tasks that are ready, and one of them at most
+            claimed = Task.objects._claim_ready_tasks(1, 0)
+            self.assertEquals([required_task.pk], [t.pk for t in claimed])
+            claimed = Task.objects._claim_ready_tasks(5, 0)
+            self.assertEquals([other_task.pk], [t.pk for t in claimed])
+            for claimed_task in [required_task, other_task]:
+                claimed_task = Task.objects.get(pk=claimed_task.pk)
+                self.assertEquals("running", claimed_task.status)
+                self.assertEquals('node1', claimed_task.node)
+
+            # Already claimed
+            self.assertEquals([], Task.objects._claim_ready_tasks(5, 0))
+            self._assert_status("scheduled", task)
+        finally:
+            del settings.TASKS_NODE_NAME
+
+    def test_dead_node_tasks(self):
+        from django.conf import settings
+        from datetime import datetime, timedelta
+        from djangotasks.models import TaskManager, TaskNode
+        task = self._task_for_object(TestModel.run_something_long, 'key1')
+        other_task = self._task_for_object(TestModel.run_something_fast, 'key1')
+        djangotasks.run_task(task)
+        djangotasks.run_task(other_task)
+        settings.TASKS_NODE_NAME = 'node1'
+        try:
+            self.assertEquals(2, len(Task.objects._claim_ready_tasks(5, 0)))
+            djangotasks.cancel_task(other_task)
+            TaskNode.objects.create(name='node1', heartbeat=datetime.now() - timedelta(seconds=300))
+            settings.TASKS_NODE_NAME = 'node2'
+            TaskManager._last_heartbeat = None
+            with LogCheck(self, 'WARNING: Node node1 has not renewed its lease for 120 seconds, failing its tasks\n'
+                          'INFO: Task %d finished with status "unsuccessful"\n'
+                          'INFO: Task %d finished with status "cancelled"\n' % (task.pk, other_task.pk)):
+                Task.objects._heartbeat()
+            self._assert_status("unsuccessful", task)
+            self._assert_status("cancelled", other_task)
+            self.assertTrue('[Node node1 was lost, the task is marked as unsuccessful]' in Task.objects.get(pk=task.pk).log)
+            from djangotasks import logstore
+            self.assertFalse(task.pk in logstore.get_store()._sequences)
+            self.assertEquals(['node2'], list(TaskNode.objects.values_list('name', flat=True)))
+
+            # Renewed at most every TASKS_NODE_HEARTBEAT_INTERVAL seconds
+            heartbeat = TaskNode.objects.get(name='node2').heartbeat
+            Task.objects._heartbeat()
+            self.assertEquals(heartbeat, TaskNode.objects.get(name='node2').heartbeat)
+        finally:
+            del settings.TASKS_NODE_NAME
+            TaskNode.objects.all().delete()
+            TaskManager._last_heartbeat = None
+
+    def test_claim_ready_tasks_by_priority(self):
+        required_task = self._task_for_object(TestModel.run_something_long, 'key1')
+        task = self._task_for_object(TestModel.run_something_with_required, 'key1')
+        low_task = djangotasks.run_task(self._task_for_object(TestModel.run_something_fast, 'key1'))
+        high_task = djangotasks.run_task(self._task_for_object(TestModel.run_something_fast, 'key2'), priority=10)
+        self.assertEquals(0, low_task.priority)
+        self.assertEquals(10, high_task.priority)
+        djangotasks.run_task(task, priority=5)
+        # The required task gets the priority of the task that requires it
+        self.assertEquals(5, Task.objects.get(pk=required_task.pk).priority)
+
+        self.assertEquals([high_task.pk], [t.pk for t in Task.objects._claim_ready_tasks(1, 0)])
+        self.assertEquals([required_task.pk, low_task.pk], [t.pk for t in Task.objects._claim_ready_tasks(5, 0)])
+
+    def test_claim_ready_tasks_by_queue(self):
+        from django.conf import settings
+        djangotasks.register_task(TestModel.run_something_fast, "Run a fast task", priority=1, queue='bulk')
+        tasks = [djangotasks.run_task(self._task_for_object(TestModel.run_something_fast, key))
+                 for key in ['key1', 'key2', 'key3']]
+        self.assertEquals(['bulk'] * 3, [task.queue for task in tasks])
+        self.assertEquals([1] * 3, [task.priority for task in tasks])
+        other_task = djangotasks.run_task(self._task_for_object(TestModel.run_something_long, 'key1'), queue='other')
+        settings.TASKS_QUEUE_MAX_RUNNING = {'bulk': 2}
+        try:
+            claimed = Task.objects._claim_ready_tasks(5, 0)
+            self.assertEquals([tasks[0].pk, tasks[1].pk, other_task.pk], [t.pk for t in claimed])
+            # The queue is full
+            self.assertEquals([], Task.objects._claim_ready_tasks(5, 0))
+
+            settings.TASKS_QUEUE_MAX_RUNNING = {'bulk': 3}
+            settings.TASKS_QUEUES = ['default', 'other']
+            # Not served by this node
+            self.assertEquals([], Task.objects._claim_ready_tasks(5, 0))
+            settings.TASKS_QUEUES = ['bulk']
+            self.assertEquals([tasks[2].pk], [t.pk for t in Task.objects._claim_ready_tasks(5, 0)])
+        finally:
+            del settings.TASKS_QUEUE_MAX_RUNNING
+            if hasattr(settings, 'TASKS_QUEUES'):
+                del settings.TASKS_QUEUES
+
+    def test_claim_ready_tasks_fair_share(self):
+        from django.conf import settings
+        big_tasks = [djangotasks.run_task(self._task_for_object(TestModel.run_something_fast, 'big%d' % i), tenant='big')
+                     for i in range(6)]
+        small_tasks = [djangotasks.run_task(self._task_for_object(TestModel.run_something_fast, 'small%d' % i), tenant='small')
+                       for i in range(2)]
+        self.assertEquals('small', small_tasks[0].tenant)
+        settings.TASKS_FAIR_SHARE = 'tenant'
+        try:
+            # The tenants take turns, instead of the tasks starting in the order in which they were run
+            claimed = Task.objects._claim_ready_tasks(4, 0)
+            self.assertEquals([big_tasks[0].pk, small_tasks[0].pk, big_tasks[1].pk, small_tasks[1].pk],
+                              [t.pk for t in claimed])
+            claimed = Task.objects._claim_ready_tasks(1, 0)
+            self.assertEquals([big_tasks[2].pk], [t.pk for t in claimed])
+
+            # The tasks of each tenant are loaded separately, TASKS_FAIR_SHARE_CANDIDATES at a time: 
+            # the tenant with more tasks queued in front does not hide the other one
+            small_tasks.append(djangotasks.run_task(self._task_for_object(TestModel.run_something_fast, 'small2'), tenant='small'))
+            settings.TASKS_FAIR_SHARE_CANDIDATES = 1
+            try:
+                claimed = Task.objects._claim_ready_tasks(1, 0)
+                self.assertEquals([small_tasks[2].pk], [t.pk for t in claimed])
+                claimed = Task.objects._claim_ready_tasks(2, 0)
+                self.assertEquals([big_tasks[3].pk, big_tasks[4].pk], [t.pk for t in claimed])
+            finally:
+                del settings.TASKS_FAIR_SHARE_CANDIDATES
+
+            settings.TASKS_FAIR_SHARE = 'customer'
+            self.assertRaises(Exception("Unknown TASKS_FAIR_SHARE 'customer', should be one of method, model, tenant"),
+                              Task.objects._claim_ready_tasks, 1, 0)
+        finally:
+            del settings.TASKS_FAIR_SHARE
+
+    def test_fair_share_simulation(self):
+        # Simulate a scheduler with 12 slots, shared by 3 tenants with tasks of random durations: 
+        # 'a' has most of the tasks, and the longest ones, and its first 100 tasks are queued before the others,
+        # many more than TASKS_FAIR_SHARE_CANDIDATES.
+        # Whenever the slots are given out, the running tasks of the tenants that have scheduled tasks 
+        # stay within one task of their share
+        import random
+        from django.conf import settings
+        weights = {'a': 2, 'b': 1, 'c': 1}
+        max_durations = {'a': 7, 'b': 1, 'c': 3}
+        randomizer = random.Random(0)
+        tenants = ['a'] * 100 + [randomizer.choice('aaaaaaaaaabc') for i in range(500)]
+        Task.objects.bulk_create([Task(model=TESTMODEL_NAME, method='run_something_fast', object_id='key%d' % i, 
+                                       status="scheduled", tenant=tenant) 
+                                  for i, tenant in enumerate(tenants)])
+        durations = dict((task.pk, randomizer.randint(1, max_durations[task.tenant])) 
+                         for task in Task.objects.filter(status="scheduled").order_by('pk'))
+
+        settings.TASKS_FAIR_SHARE = 'tenant'
+        settings.TASKS_FAIR_SHARE_WEIGHTS = weights
+        settings.TASKS_FAIR_SHARE_CANDIDATES = 5
+        try:
+            running = [] # (end time, pk, tenant)
+            for now in range(60):
+                Task.objects.filter(pk__in=[pk for end, pk, _ in running if end <= now]).update(status="successful")
+                running = [(end, pk, tenant) for end, pk, tenant in running if end > now]
+                if len(running) < 12:
+                    for task in Task.objects._claim_ready_tasks(12 - len(running), 0):
+                        running.append((now + durations[task.pk], task.pk, task.tenant))
+
+                self.assertEquals(12, len(running))
+                usage = dict((key, len([1 for _, _, tenant in running if tenant == key])) for key in weights)
+                waiting = [key for key in weights if Task.objects.filter(status="scheduled", tenant=key).exists()]
+                for key in waiting:
+                    for other_key in waiting:
+                        self.assertTrue((usage[key] - 1.0) / weights[key] <= float(usage[other_key]) / weights[other_key],
+                                        "Unfair at time %d: %r" % (now, usage))
+            # Some tenants have run out of tasks before the end
+            self.assertTrue(len(waiting) < len(weights))
+        finally:
+            del settings.TASKS_FAIR_SHARE
+            del settings.TASKS_FAIR_SHARE_WEIGHTS
+            del settings.TASKS_FAIR_SHARE_CANDIDATES
+
+    def test_cancel_task_on_other_node(self):
+        task = self._task_for_object(TestModel.run_something_long, 'key1')
+        djangotasks.run_task(task)
+        Task.objects.filter(pk=task.pk).update(status="running", node="some other node", pid=os.getpid())
+        djangotasks.cancel_task(task)
+        with LogCheck(self):
+            Task.objects._do_schedule()
+        self._assert_status("requested_cancel", task)
+
+    def test_append_log(self):
+        from djangotasks.models import TaskLogChunk
+        task = self._task_for_object(TestModel.run_something_long, 'key1')
+        self.assertEquals(u'', task.log)
+        Task.objects.append_log(task.pk, 'first line\n')
+        Task.objects.append_log(task.pk, '')
+        Task.objects.append_log(task.pk, 'second line\n')
+        self.assertEquals([(0, u'first line\n'), (1, u'second line\n')],
+                          list(TaskLogChunk.objects.filter(task=task.pk).order_by('sequence').values_list('sequence', 'text')))
+        self.assertEquals(u'first line\nsecond line\n', Task.objects.get(pk=task.pk).log)
+
+        # Written by a different process in the meantime
+        TaskLogChunk.objects.create(task_id=task.pk, sequence=2, text='other process\n')
+        Task.objects.append_log(task.pk, 'third line\n')
+        self.assertEquals(u'first line\nsecond line\nother process\nthird line\n', Task.objects.get(pk=task.pk).log)
+
+        task = Task.objects.get(pk=task.pk)
+        task.log = 'replaced'
+        task.save()
+        self.assertEquals(u'replaced', Task.objects.get(pk=task.pk).log)
+        self.assertEquals(1, TaskLogChunk.objects.filter(task=task.pk).count())
+
+        task_id = task.pk
+        task.delete()
+        self.assertEquals(0, TaskLogChunk.objects.filter(task=task_id).count())
+
+        task_id = 999999
+        self.assertRaises(Exception("Failed to save log for task %d, task does not exist; log was:\nlost" % task_id),
+                          Task.objects.append_log, task_id, 'lost')
+
+    def test_append_logs(self):
+        from django.conf import settings
+        from django.db import connection
+        from djangotasks.models import TaskLogChunk
+        task1 = self._task_for_object(TestModel.run_something_long, 'key1')
+        task2 = self._task_for_object(TestModel.run_something_long, 'key2')
+        Task.objects.append_log(task1.pk, 'first line\n')
+        with LogCheck(self, 'ERROR: Failed to save log for task 999999, task does not exist; log was:\nlost\n'):
+            Task.objects.append_logs({task1.pk: 'second line\n', task2.pk: 'first line\n', 999999: 'lost'})
+        self.assertEquals(u'first line\nsecond line\n', Task.objects.get(pk=task1.pk).log)
+        self.assertEquals(u'first line\n', Task.objects.get(pk=task2.pk).log)
+
+        # A single insert, whatever the number of tasks, where the database has savepoints 
+        # (otherwise one insert, and one query for its sequence, per task)
+        old_debug = settings.DEBUG
+        settings.DEBUG = True # for connection.queries
+        try:
+            connection.queries = []
+            Task.objects.append_logs({task1.pk: 'third line\n', task2.pk: 'second line\n'})
+            self.assertEquals(1 if connection.features.uses_savepoints else 4, 
+                              len([query['sql'] for query in connection.queries
+                                   if TaskLogChunk._meta.db_table in query['sql']]))
+        finally:
+            settings.DEBUG = old_debug
+        self.assertEquals(u'first line\nsecond line\nthird line\n', Task.objects.get(pk=task1.pk).log)
+        self.assertEquals(u'first line\nsecond line\n', Task.objects.get(pk=task2.pk).log)
+
+        # Written by a different process in the meantime
+        TaskLogChunk.objects.create(task_id=task2.pk, sequence=2, text='other process\n')
+        Task.objects.append_logs({task1.pk: 'fourth line\n', task2.pk: 'third line\n'})
+        self.assertEquals(u'first line\nsecond line\nthird line\nfourth line\n', Task.objects.get(pk=task1.pk).log)
+        self.assertEquals(u'first line\nsecond line\nother process\nthird line\n', Task.objects.get(pk=task2.pk).log)
+
+    def test_append_logs_file(self):
+        from django.conf import settings
+        settings.TASKS_LOG_BACKEND = 'file'
+        settings.TASKS_LOG_DIR = join(self.tempdir, 'logs')
+        try:
+            task1 = self._task_for_object(TestModel.run_something_long, 'key1')
+            task2 = self._task_for_object(TestModel.run_something_long, 'key2')
+            Task.objects.append_log(task1.pk, 'first line\n')
+            with LogCheck(self, 'ERROR: Failed to save log for task 999999, task does not exist; log was:\nlost\n'):
+                Task.objects.append_logs({task1.pk: u'second line \xe9\n', task2.pk: 'first line\n', 999999: 'lost'})
+            task1 = Task.objects.get(pk=task1.pk)
+            self.assertEquals(26, task1.log_length)
+            self.assertEquals(u'first line\nsecond line \xe9\n', task1.log)
+            task2 = Task.objects.get(pk=task2.pk)
+            self.assertEquals(join(self.tempdir, 'logs', '%d.log' % task2.pk), task2.log_path)
+            self.assertEquals(u'first line\n', task2.log)
+            self.assertFalse(exists(join(self.tempdir, 'logs', '999999.log')))
+        finally:
+            del settings.TASKS_LOG_BACKEND
+            del settings.TASKS_LOG_DIR
+
+    def test_log_limits(self):
+        from django.conf import settings
+        from djangotasks import logstore
+        settings.TASKS_LOG_HEAD_BYTES = 10
+        settings.TASKS_LOG_TAIL_BYTES = 10
+        old_slack = logstore.TRUNCATION_SLACK
+        logstore.TRUNCATION_SLACK = 0
+        try:
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            Task.objects.append_log(task.pk, '0123456789' + 'x' * 5)
+            self.assertEquals(u'0123456789xxxxx', Task.objects.get(pk=task.pk).log)
+            Task.objects.append_log(task.pk, 'x' * 20)
+            self.assertEquals(u'0123456789\n[... 15 bytes truncated ...]\nxxxxxxxxxx', Task.objects.get(pk=task.pk).log)
+            Task.objects.append_logs({task.pk: 'abcdefghij'})
+            self.assertEquals(u'0123456789\n[... 25 bytes truncated ...]\nabcdefghij', Task.objects.get(pk=task.pk).log)
+            # Multi-byte characters are not cut
+            Task.objects.append_log(task.pk, u'\xe9' * 10 + u'z')
+            self.assertEquals(u'0123456789\n[... 45 bytes truncated ...]\n' + u'\xe9' * 5 + u'z',
+                              Task.objects.get(pk=task.pk).log)
+        finally:
+            logstore.TRUNCATION_SLACK = old_slack
+            logstore._sizes.clear()
+            del settings.TASKS_LOG_HEAD_BYTES
+            del settings.TASKS_LOG_TAIL_BYTES
+
+    def test_log_compressed(self):
+        from django.conf import settings
+        from djangotasks import logstore
+        from djangotasks.models import TaskLogChunk
+        settings.TASKS_LOG_COMPRESS = True
+        try:
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            Task.objects.append_log(task.pk, 'first line\n')
+            Task.objects.append_log(task.pk, u'second line \xe9\n')
+            logstore.task_finished(task.pk)
+            self.assertTrue(logstore.wait_compressed(10))
+            self.assertEquals([True], list(TaskLogChunk.objects.filter(task=task.pk).values_list('compressed', flat=True)))
+            task = Task.objects.get(pk=task.pk)
+            self.assertEquals(u'first line\nsecond line \xe9\n', task.log)
+            self.assertTrue(u'\nfirst line\nsecond line \xe9\n' in task.formatted_log())
+            self.assertEquals((u'second line \xe9\n', 26), djangotasks.tail_log(task, 11))
+            # Appended to, after it is compressed, e.g. by the process of a cancelled task
+            Task.objects.append_log(task.pk, 'late line\n')
+            self.assertEquals(u'first line\nsecond line \xe9\nlate line\n', Task.objects.get(pk=task.pk).log)
+
+            settings.TASKS_LOG_BACKEND = 'file'
+            settings.TASKS_LOG_DIR = join(self.tempdir, 'logs')
+            task = self._task_for_object(TestModel.run_something_long, 'key2')
+            Task.objects.append_log(task.pk, 'first line\n')
+            Task.objects.append_log(task.pk, u'second line \xe9\n')
+            logstore.task_finished(task.pk)
+            self.assertTrue(logstore.wait_compressed(10))
+            task = Task.objects.get(pk=task.pk)
+            self.assertEquals(join(self.tempdir, 'logs', '%d.log.z' % task.pk), task.log_path)
+            self.assertFalse(exists(join(self.tempdir, 'logs', '%d.log' % task.pk)))
+            self.assertEquals(26, task.log_length)
+            self.assertEquals(u'first line\nsecond line \xe9\n', task.log)
+            self.assertEquals(u'second', djangotasks.read_log_range(task, 11, 17))
+            self.assertEquals((u'second line \xe9\n', 26), djangotasks.tail_log(task, 11))
+            # Uncompressed to be appended to, then compressed again
+            Task.objects.append_logs({task.pk: 'late line\n'})
+            task = Task.objects.get(pk=task.pk)
+            self.assertEquals(join(self.tempdir, 'logs', '%d.log' % task.pk), task.log_path)
+            self.assertFalse(exists(join(self.tempdir, 'logs', '%d.log.z' % task.pk)))
+            self.assertEquals(u'first line\nsecond line \xe9\nlate line\n', task.log)
+            logstore.task_finished(task.pk)
+            self.assertTrue(logstore.wait_compressed(10))
+            task = Task.objects.get(pk=task.pk)
+            self.assertEquals(36, task.log_length)
+            self.assertEquals(u'first line\nsecond line \xe9\nlate line\n', task.log)
+            log_path = task.log_path
+            task.delete()
+            self.assertFalse(exists(log_path))
+        finally:
+            del settings.TASKS_LOG_COMPRESS
+            if hasattr(settings, 'TASKS_LOG_BACKEND'):
+                del settings.TASKS_LOG_BACKEND
+                del settings.TASKS_LOG_DIR
+
+    def test_log_not_loaded(self):
+        # The log is not part of the task row: the scheduler, the status and the admin changelist never read it
+        from django.conf import settings
+        from django.db import connection
+        from django.contrib import admin
+        from djangotasks.admin import TaskAdmin
+        from djangotasks.models import TaskLogChunk
+        task = self._task_for_object(TestModel.run_something_long, 'key1')
+        Task.objects.append_log(task.pk, 'x' * 100000)
+        djangotasks.run_task(task)
+
+        old_debug = settings.DEBUG
+        settings.DEBUG = True # for connection.queries
+        try:
+            connection.queries = []
+            claimed = Task.objects._claim_ready_tasks(1, 0)
+            self.assertEquals([task.pk], [t.pk for t in claimed])
+            tasks = list(Task.objects.filter(model='djangotasks.testmodel'))
+            task_admin = TaskAdmin(Task, admin.site)
+            for t in tasks:
+                for field in task_admin.list_display:
+                    value = getattr(t, field)
+                    if callable(value):
+                        value()
+            djangotasks.cancel_task(task)
+            from django.core.management import call_command
+            call_command('taskstatus')
+            self.assertEquals([], [query['sql'] for query in connection.queries 
+                                   if TaskLogChunk._meta.db_table in query['sql']])
+            self.assertFalse([t for t in claimed + tasks if getattr(t, '_log', None) is not None])
+        finally:
+            settings.DEBUG = old_debug
+        Task.objects.filter(pk=task.pk).update(status="cancelled")
+
+    def test_append_log_file(self):
+        from django.conf import settings
+        from djangotasks.models import TaskLogChunk
+        settings.TASKS_LOG_BACKEND = 'file'
+        settings.TASKS_LOG_DIR = join(self.tempdir, 'logs')
+        try:
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            self.assertEquals(u'', task.log)
+            self.assertEquals((u'', 0), djangotasks.tail_log(task))
+            Task.objects.append_log(task.pk, 'first line\n')
+            Task.objects.append_log(task.pk, u'second line \xe9\n')
+            self.assertEquals(0, TaskLogChunk.objects.filter(task=task.pk).count())
+
+            task = Task.objects.get(pk=task.pk)
+            self.assertEquals(join(self.tempdir, 'logs', '%d.log' % task.pk), task.log_path)
+            self.assertEquals(26, task.log_length)
+            self.assertEquals(u'first line\nsecond line \xe9\n', task.log)
+            self.assertEquals(u'second', djangotasks.read_log_range(task, 11, 17))
+            self.assertEquals(u'line \xe9\n', djangotasks.read_log_range(task, 18))
+
+            self.assertEquals((u'first line\nsecond line \xe9\n', 26), djangotasks.tail_log(task))
+            self.assertEquals((u'second line \xe9\n', 26), djangotasks.tail_log(task, 11))
+            # The end of a character that is not written yet is not returned 
+            open(task.log_path, 'ab').write('third \xc3')
+            Task.objects.filter(pk=task.pk).update(log_length=33)
+            self.assertEquals((u'third ', 32), djangotasks.tail_log(task, 26))
+            Task.objects.append_log(task.pk, '\xa9\n')
+            self.assertEquals((u'\xe9\n', 35), djangotasks.tail_log(task, 32))
+            self.assertEquals((u'', 35), djangotasks.tail_log(task, 35))
+
+            task = Task.objects.get(pk=task.pk)
+            task.log = 'replaced'
+            task.save()
+            self.assertEquals(u'replaced', Task.objects.get(pk=task.pk).log)
+            self.assertEquals(8, Task.objects.get(pk=task.pk).log_length)
+
+            log_path = task.log_path
+            task.delete()
+            self.assertFalse(exists(log_path))
+
+            task_id = 999999
+            self.assertRaises(Exception("Failed to save log for task %d, task does not exist; log was:\nlost" % task_id),
+                              Task.objects.append_log, task_id, 'lost')
+            self.assertFalse(exists(join(self.tempdir, 'logs', '%d.log' % task_id)))
+        finally:
+            del settings.TASKS_LOG_BACKEND
+            del settings.TASKS_LOG_DIR
+
+    def test_tasks_run_log_file(self):
+        from django.conf import settings
+        settings.TASKS_LOG_BACKEND = 'file'
+        settings.TASKS_LOG_DIR = join(self.tempdir, 'logs')
+        try:
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            djangotasks.run_task(task)
+            self._check_running('key1', task, None, 'run_something_long_2',
+                                u'running run_something_long_1\nrunning run_something_long_2\n')
+            self.assertEquals((u'running run_something_long_2\n', 58), djangotasks.tail_log(task, 29))
+        finally:
+            del settings.TASKS_LOG_BACKEND
+            del settings.TASKS_LOG_DIR
+
+    def test_wakeup_scheduler(self):
+        from django.conf import settings
+        from djangotasks import wakeup
+        settings.TASKS_WAKEUP_SOCKET = join(self.tempdir, 'taskd.sock')
+        waiter = wakeup.Waiter()
+        try:
+            self.assertFalse(waiter.wait(0.1))
+
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            djangotasks.run_task(task)
+            djangotasks.run_task(task)
+            start = time.time()
+            self.assertTrue(waiter.wait(5))
+            self.assertTrue(time.time() - start < 1)
+            # the two notifications result in a single wake-up
+            self.assertFalse(waiter.wait(0.1))
+
+            djangotasks.cancel_task(task)
+            self.assertTrue(waiter.wait(5))
+
+            # The socket of a live scheduler is not taken over
+            with LogCheck(self, 'ERROR: The wake-up socket %s is used by another scheduler, this one will only poll\n' % settings.TASKS_WAKEUP_SOCKET):
+                other_waiter = wakeup.Waiter()
+            other_waiter.close()
+            wakeup.notify()
+            self.assertTrue(waiter.wait(5))
+        finally:
+            waiter.close()
+            del settings.TASKS_WAKEUP_SOCKET
+        self.assertFalse(exists(join(self.tempdir, 'taskd.sock')))
+
+    def test_wakeup_socket_path(self):
+        from djangotasks import wakeup
+        # Different for each database
+        self.assertTrue(wakeup._socket_path().startswith(join('/tmp', 'django-taskd-')))
+
+    def test_tasks_run_fork_server(self):
+        from django.conf import settings
+        from djangotasks import forkserver
+        settings.TASKS_FORK_SERVER = True
+        try:
+            # As the scheduler does when it starts
+            forkserver.start()
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            djangotasks.run_task(task)
+            self._check_running('key1', task, None, 'run_something_long_2',
+                                u'running run_something_long_1\nrunning run_something_long_2\n')
+            self.assertTrue(forkserver.is_running())
+            self.assertNotEquals(os.getpid(), Task.objects.get(pk=task.pk).pid)
+
+            task = self._task_for_object(TestModel.run_something_failing, 'key1')
+            djangotasks.run_task(task)
+            with LogCheck(self, _start_message(task)):
+                Task.objects._do_schedule()
+            self._wait_until('key1', "run_something_failing")
+            time.sleep(0.5)
+            new_task = Task.objects.get(pk=task.pk)
+            self.assertEquals("unsuccessful", new_task.status)
+            self.assertTrue(u'Exception: Failed !' in new_task.log)
+        finally:
+            forkserver.stop()
+            del settings.TASKS_FORK_SERVER
+
+    def test_tasks_fork_server_not_restarted(self):
+        from django.conf import settings
+        from djangotasks import forkserver
+        settings.TASKS_FORK_SERVER = True
+        try:
+            forkserver.start()
+            forkserver.stop()
+            task = self._task_for_object(TestModel.run_something_fast, 'key1')
+            djangotasks.run_task(task)
+            # Started as a new process instead
+            self._check_running('key1', task, None, 'run_something_fast', u'running run_something_fast\n')
+            self.assertFalse(forkserver.is_running())
+        finally:
+            del settings.TASKS_FORK_SERVER
+
+    def test_tasks_cancel_fork_server(self):
+        from django.conf import settings
+        from djangotasks import forkserver
+        settings.TASKS_FORK_SERVER = True
+        try:
+            forkserver.start()
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            djangotasks.run_task(task)
+            with LogCheck(self, _start_message(task)):
+                Task.objects._do_schedule()
+            self._wait_until('key1', "run_something_long_1")
+            djangotasks.cancel_task(task)
+            with LogCheck(self, fail_if_different=False):
+                Task.objects._do_schedule()
+                time.sleep(0.3)
+            new_task = Task.objects.get(pk=task.pk)
+            self.assertEquals("cancelled", new_task.status)
+            self.assertTrue(u'running run_something_long_1' in new_task.log)
+            self.assertFalse(u'running run_something_long_2' in new_task.log)
+        finally:
+            forkserver.stop()
+            del settings.TASKS_FORK_SERVER
+
     def test_tasks_run_failing(self):
         task = self._task_for_object(TestModel.run_something_failing, 'key1')
         djangotasks.run_task(task)
@@ -379,11 +1178,15 @@ class TasksTestCase(unittest.TestCase):
         self.assertEquals('defined', tasks[1].status)
         self.assertEquals('run_something_long', tasks[0].method)
         self.assertEquals('run_something_else', tasks[1].method)
+        self.assertEquals('Run a successful task', tasks[0].description)
+        self.assertEquals([task.pk for task in tasks], [task.pk for task in self._tasks_for_object('key2')])
 
     def test_tasks_get_task_for_object(self):
         task = self._task_for_object(TestModel.run_something_long, 'key2')
         self.assertEquals('defined', task.status)
         self.assertEquals('run_something_long', task.method)
+        self.assertEquals('Run a successful task', task.description)
+        self.assertEquals(task.pk, self._task_for_object(TestModel.run_something_long, 'key2').pk)
 
     def test_tasks_get_task_for_object_required(self):
         task = self._task_for_object(TestModel.run_something_with_two_required, 'key-more')
@@ -414,6 +1217,126 @@ class TasksTestCase(unittest.TestCase):
         self.assertEquals(['run_something_long', 'run_something_with_required'],
                           [required_task.method for required_task in task.get_required_tasks()])
 
+    def test_tasks_required_tasks(self):
+        task1 = self._task_for_object(TestModel.run_something_with_two_required, 'key1')
+        task2 = self._task_for_object(TestModel.run_something_with_required, 'key2')
+        task3 = self._task_for_object(TestModel.run_something_long, 'key3')
+        required_task = self._task_for_object(TestModel.run_something_long, 'key1')
+        required_tasks = Task.objects.required_tasks([task1, task2, task3])
+        self.assertEquals([('run_something_long', task1.object_id), ('run_something_with_required', task1.object_id)],
+                          [(t.method, t.object_id) for t in required_tasks[task1.pk]])
+        self.assertEquals(required_task.pk, required_tasks[task1.pk][0].pk)
+        # created if needed
+        self.assertEquals([('run_something_long', task2.object_id)],
+                          [(t.method, t.object_id) for t in required_tasks[task2.pk]])
+        self.assertEquals('defined', required_tasks[task2.pk][0].status)
+        self.assertEquals(required_tasks[task2.pk][0].pk, 
+                          self._task_for_object(TestModel.run_something_long, 'key2').pk)
+        self.assertEquals([], required_tasks[task3.pk])
+
+    def test_tasks_all_required_tasks(self):
+        task = self._task_for_object(TestModel.run_something_with_required_with_two_required, 'key1')
+        self.assertEquals(['run_something_long', 'run_something_with_required', 'run_something_with_two_required'],
+                          [t.method for t in Task.objects.required_tasks([task], all_required=True)[task.pk]])
+        self.assertEquals(['run_something_long', 'run_something_with_required', 'run_something_with_two_required', 
+                           'run_something_with_required_with_two_required'],
+                          [t.method for t in task._unique_required_tasks()])
+        self.assertEquals(['run_something_with_two_required', 'run_something_with_required_with_two_required'],
+                          [t.method for t in task._unique_required_tasks(True)])
+
+    def test_tasks_for_objects(self):
+        existing_task = self._task_for_object(TestModel.run_something_long, 'key1')
+        for key in ['key2', 'key3']:
+            TestModel.objects.get_or_create(pk=join(self.tempdir, key))
+        queryset = TestModel.objects.filter(pk__startswith=self.tempdir).order_by('pk')
+
+        tasks = list(djangotasks.tasks_for_objects(queryset, TestModel.run_something_long))
+        self.assertEquals([join(self.tempdir, key) for key in ['key1', 'key2', 'key3']], [task.object_id for task in tasks])
+        self.assertEquals(existing_task.pk, tasks[0].pk)
+        self.assertEquals(['defined'] * 3, [task.status for task in tasks])
+        self.assertEquals("Run a successful task", tasks[1].description)
+        self.assertEquals(3, djangotasks.tasks_for_objects(queryset, TestModel.run_something_long).count())
+
+        # As when they are created one by one, the objects must exist
+        missing_key = join(self.tempdir, 'missing')
+        self.assertRaises(TestModel.DoesNotExist, Task.objects.tasks_for_methods, 
+                          [(TESTMODEL_NAME, missing_key, 'run_something_long')])
+        self.assertEquals(0, Task.objects.filter(object_id=missing_key).count())
+
+    def test_run_tasks_for_queryset(self):
+        from django.conf import settings
+        successful_task = self._task_for_object(TestModel.run_something_long, 'key1')
+        Task.objects.filter(pk=successful_task.pk).update(status="successful")
+        cancelling_task = self._task_for_object(TestModel.run_something_with_required, 'key2')
+        Task.objects.filter(pk=cancelling_task.pk).update(status="requested_cancel")
+        TestModel.objects.get_or_create(pk=join(self.tempdir, 'key3'))
+        queryset = TestModel.objects.filter(pk__startswith=self.tempdir).order_by('pk')
+
+        settings.TASKS_BULK_BATCH_SIZE = 2
+        try:
+            tasks = list(djangotasks.run_tasks_for_queryset(queryset, TestModel.run_something_with_required))
+        finally:
+            del settings.TASKS_BULK_BATCH_SIZE
+        self.assertEquals(['scheduled', 'requested_cancel', 'scheduled'], [task.status for task in tasks])
+        self.assertEquals(cancelling_task.pk, tasks[1].pk)
+        from djangotasks.models import TaskEvent
+        self.assertEquals([('defined', 'scheduled')], 
+                          list(TaskEvent.objects.filter(task=tasks[2].pk).values_list('from_status', 'to_status')))
+
+        # The required tasks are run, except the successful ones
+        required_tasks = list(djangotasks.tasks_for_objects(queryset, TestModel.run_something_long))
+        self.assertEquals(['successful', 'defined', 'scheduled'], [task.status for task in required_tasks])
+        self.assertEquals(successful_task.pk, required_tasks[0].pk)
+
+        # Run again: the finished tasks are archived, and new ones created
+        Task.objects.filter(pk=tasks[0].pk).update(status="unsuccessful")
+        new_tasks = list(djangotasks.run_tasks_for_queryset(queryset.filter(pk=tasks[0].object_id), 
+                                                            TestModel.run_something_with_required))
+        self.assertEquals(['scheduled'], [task.status for task in new_tasks])
+        self.assertNotEquals(tasks[0].pk, new_tasks[0].pk)
+        self.assertTrue(Task.objects.get(pk=tasks[0].pk).archived)
+        self.assertTrue(djangotasks.run_tasks_for_objects is djangotasks.run_tasks_for_queryset)
+
+    def test_statuses_for_objects(self):
+        from django.conf import settings
+        from django.core.cache import cache
+        task = self._task_for_object(TestModel.run_something_long, 'key1')
+        object1 = TestModel.objects.get(pk=task.object_id)
+        object2, _ = TestModel.objects.get_or_create(pk=join(self.tempdir, 'key2'))
+        settings.TASKS_STATUS_CACHE = True
+        try:
+            cache.clear()
+            statuses = djangotasks.statuses_for_objects([object1, object2])
+            self.assertEquals(dict((method, 'defined') for method, _, _ in TEST_DEFINED_TASKS), statuses[object2])
+            self.assertEquals('defined', statuses[object1]['run_something_long'])
+            # No task is created
+            self.assertEquals(0, Task.objects.filter(object_id=object2.pk).count())
+
+            djangotasks.run_task(task)
+            self.assertEquals('scheduled', djangotasks.statuses_for_objects([object1])[object1]['run_something_long'])
+            Task.objects._claim_ready_tasks(1, 0)
+            self.assertEquals('running', djangotasks.statuses_for_objects([object1])[object1]['run_something_long'])
+
+            # Read from the cache
+            Task.objects.filter(pk=task.pk).update(status="successful")
+            self.assertEquals('running', djangotasks.statuses_for_objects([object1])[object1]['run_something_long'])
+            Task.objects.mark_finished(task.pk, "unsuccessful", "successful")
+            self.assertEquals('unsuccessful', djangotasks.statuses_for_objects([object1])[object1]['run_something_long'])
+
+            # A new task replaces the old one
+            new_task = djangotasks.run_task(task)
+            self.assertNotEquals(task.pk, new_task.pk)
+            self.assertEquals('scheduled', djangotasks.statuses_for_objects([object1])[object1]['run_something_long'])
+
+            # The tasks created in bulk are cached too
+            object3, _ = TestModel.objects.get_or_create(pk=join(self.tempdir, 'key3'))
+            Task.objects.tasks_for_methods([(TESTMODEL_NAME, object3.pk, 'run_something_long')])
+            Task.objects.filter(object_id=object3.pk).update(status="successful")
+            self.assertEquals('defined', djangotasks.statuses_for_objects([object3])[object3]['run_something_long'])
+        finally:
+            del settings.TASKS_STATUS_CACHE
+            cache.clear()
+
     def _check_running(self, key, current_task, previous_task, task_name, expected_log=None):
         self._assert_status("scheduled", current_task)
         with LogCheck(self, _start_message(current_task)):
@@ -688,8 +1611,65 @@ class TasksTestCase(unittest.TestCase):
             task.save()
         
         task_completed.connect(receiver)
-        task = self._task_for_object(TestModel.run_something_fast, 'key1')
-        djangotasks.run_task(task)
-        self._check_running('key1', task, None, 'run_something_fast',
-                            u'Text added from the signal receiver')
-        task_completed.disconnect()
+        try:
+            task = self._task_for_object(TestModel.run_something_fast, 'key1')
+            djangotasks.run_task(task)
+            self._check_running('key1', task, None, 'run_something_fast', u'Text added from the signal receiver')
+        finally:
+            task_completed.disconnect(receiver)
+
+    def test_send_signal_on_task_completed_failing_receiver(self):
+        from djangotasks.signals import task_completed
+        def receiver(sender, **kwargs):
+            raise Exception("Failing receiver")
+
+        task_completed.connect(receiver)
+        try:
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            Task.objects.filter(pk=task.pk).update(status="running")
+            # Sent by mark_finished itself, which logs the exception: the task is finished anyway
+            with LogCheck(self, fail_if_different=False):
+                self.assertTrue(Task.objects.mark_finished(task.pk, "successful", "running"))
+            self.assertEquals("successful", Task.objects.get(pk=task.pk).status)
+        finally:
+            task_completed.disconnect(receiver)
+
+    def test_send_signal_on_task_completed_async(self):
+        from django.conf import settings
+        from djangotasks import signals
+        received = []
+        def receiver(sender, **kwargs):
+            received.append((kwargs['task'].pk, kwargs['object']))
+            raise Exception("Failing receiver")
+
+        signals.task_completed.connect(receiver)
+        settings.TASKS_ASYNC_SIGNALS = True
+        try:
+            task = self._task_for_object(TestModel.run_something_long, 'key1')
+            Task.objects.filter(pk=task.pk).update(status="running")
+            with LogCheck(self, fail_if_different=False):
+                Task.objects.mark_finished(task.pk, "successful", "running")
+                self.assertTrue(signals.drain(10))
+            # The exceptions of the receivers are only logged
+            self.assertEquals([(task.pk, TestModel.objects.get(pk=task.object_id))], received)
+            self.assertEquals(TestModel, received[0][1].__class__)
+        finally:
+            del settings.TASKS_ASYNC_SIGNALS
+            signals.task_completed.disconnect(receiver)
+
+    def test_send_signal_on_tasks_completed(self):
+        from djangotasks.signals import tasks_completed
+        received = []
+        def receiver(sender, **kwargs):
+            received.append(([task.pk for task in kwargs['tasks']], [object.pk for object in kwargs['objects']]))
+
+        tasks_completed.connect(receiver)
+        try:
+            tasks = [self._task_for_object(TestModel.run_something_long, key) for key in ['key1', 'key2']]
+            for task in tasks:
+                Task.objects.filter(pk=task.pk).update(status="running")
+                Task.objects.mark_finished(task.pk, "successful", "running")
+            self.assertEquals([task.pk for task in tasks], [pk for pks, _ in received for pk in pks])
+            self.assertEquals([task.object_id for task in tasks], [pk for _, pks in received for pk in pks])
+        finally:
+            tasks_completed.disconnect(receiver)
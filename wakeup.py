@@ -0,0 +1,210 @@
+#
+# Copyright (c) 2011 by nexB, Inc. http://www.nexb.com/ - All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without modification,
+# are permitted provided that the following conditions are met:
+# 
+#     1. Redistributions of source code must retain the above copyright notice,
+#        this list of conditions and the following disclaimer.
+#    
+#     2. Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+# 
+#     3. Neither the names of Django, nexB, Django-tasks nor the names of the contributors may be used
+#        to endorse or promote products derived from this software without
+#        specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+# ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Wake-up channel of the scheduler.
+#
+# run_task, cancel_task and mark_finished call notify(), so that the scheduler reacts right away
+# instead of waiting for its next poll (see TASKS_POLL_INTERVAL).
+#
+# On a single host, the notifications go through a Unix datagram socket (see TASKS_WAKEUP_SOCKET), 
+# whose default path depends on the database, so that the schedulers of different projects do not share it.
+# The notifications may be sent before the transaction that runs the task is committed: 
+# the scheduler runs a follow-up pass shortly after each wake-up (see TASKS_WAKEUP_FOLLOW_UP).
+# With several hosts sharing a PostgreSQL database, setting TASKS_WAKEUP_DB_NOTIFY sends them
+# through LISTEN/NOTIFY as well.
+#
+# mark_finished also calls task_finished(), which wakes up the threads of this process 
+# that wait for tasks to finish (see wait_finished).
+#
+
+from __future__ import with_statement
+
+import os
+import errno
+import socket
+import select
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection, transaction
+
+LOG = logging.getLogger("djangotasks")
+
+DB_CHANNEL = 'djangotasks'
+
+def _socket_path():
+    if hasattr(settings, 'TASKS_WAKEUP_SOCKET'):
+        return settings.TASKS_WAKEUP_SOCKET
+    import hashlib
+    database = '%(NAME)s@%(HOST)s:%(PORT)s' % connection.settings_dict
+    return os.path.join(os.getenv('TEMP') if (os.name == 'nt') else '/tmp',
+                        'django-taskd-%s.sock' % hashlib.md5(database).hexdigest()[:12])
+
+def _is_live(path):
+    # True if a socket is bound to path, e.g. by the scheduler of a different process
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+def _db_notify_enabled():
+    return (getattr(settings, 'TASKS_WAKEUP_DB_NOTIFY', False) and 
+            getattr(connection, 'vendor', None) == 'postgresql')
+
+def notify():
+    ''' Wake up the scheduler(s). Never fails: the scheduler polls anyway.'''
+    path = _socket_path()
+    if path and hasattr(socket, 'AF_UNIX'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(0)
+            sock.sendto('.', path)
+        except socket.error:
+            # No scheduler listening on this host, or it already has pending wake-ups
+            pass
+        finally:
+            sock.close()
+
+    if _db_notify_enabled():
+        try:
+            connection.cursor().execute('NOTIFY ' + DB_CHANNEL)
+            transaction.commit_unless_managed()
+        except Exception:
+            LOG.exception("Failed to notify the schedulers through the database")
+
+
+class Waiter(object):
+    ''' The receiving end of the wake-up channel, used by the scheduler.'''
+
+    def __init__(self):
+        self._socket = None
+        self._db_connection = None
+
+        path = _socket_path()
+        if path and hasattr(socket, 'AF_UNIX'):
+            if os.path.exists(path) and _is_live(path):
+                LOG.error("The wake-up socket %s is used by another scheduler, this one will only poll", path)
+            else:
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                    self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    self._socket.bind(path)
+                    self._socket.setblocking(0)
+                except (socket.error, OSError):
+                    LOG.exception("Failed to create the wake-up socket %s, the scheduler will only poll", path)
+                    self._socket = None
+
+        if _db_notify_enabled():
+            try:
+                self._db_connection = self._listen()
+            except Exception:
+                LOG.exception("Failed to listen to database notifications, the scheduler will only poll")
+
+    def _listen(self):
+        # A dedicated connection, in autocommit mode: notifications are only received outside of transactions
+        import psycopg2
+        import psycopg2.extensions
+        settings_dict = connection.settings_dict
+        params = {'database': settings_dict['NAME']}
+        for key in ['USER', 'PASSWORD', 'HOST', 'PORT']:
+            if settings_dict.get(key):
+                params[key.lower()] = settings_dict[key]
+        db_connection = psycopg2.connect(**params)
+        db_connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        db_connection.cursor().execute('LISTEN ' + DB_CHANNEL)
+        return db_connection
+
+    def wait(self, timeout):
+        ''' Wait until notified, or until the timeout (in seconds) expires.
+
+        Returns True if notified. All the pending notifications are consumed, 
+        so that a burst of notifications results in a single wake-up.'''
+        fds = [f for f in [self._socket, self._db_connection] if f is not None]
+        if not fds:
+            import time
+            time.sleep(timeout)
+            return False
+
+        try:
+            readable, _, _ = select.select(fds, [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return False
+
+        if self._socket in readable:
+            try:
+                while self._socket.recv(64):
+                    pass
+            except socket.error:
+                pass
+        if self._db_connection is not None and self._db_connection in readable:
+            self._db_connection.poll()
+            del self._db_connection.notifies[:]
+        return bool(readable)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.remove(_socket_path())
+            except OSError:
+                pass
+        if self._db_connection is not None:
+            self._db_connection.close()
+            self._db_connection = None
+
+
+# The number of tasks finished in this process so far, and the condition notified when it changes
+_finished_count = 0
+_finished_condition = threading.Condition()
+
+def finished_count():
+    return _finished_count
+
+def task_finished():
+    ''' Wake up the threads of this process that wait for tasks to finish.'''
+    global _finished_count
+    with _finished_condition:
+        _finished_count += 1
+        _finished_condition.notifyAll()
+
+def wait_finished(count, timeout):
+    ''' Wait until a task finishes in this process, if none did since finished_count() returned count, 
+    or until the timeout (in seconds) expires.'''
+    with _finished_condition:
+        if _finished_count == count:
+            _finished_condition.wait(timeout)